@@ -2,8 +2,9 @@
 
 import argparse
 import os
+import queue
 import sys
-import tempfile
+import threading
 import time
 
 import torch
@@ -29,7 +30,7 @@ parser.add_argument(
     '-V, --voices-dir', metavar='VOICES_DIR', type=str, dest='voices_dir',
     help='Path to directory containing extra voices to be loaded. Use a comma to specify multiple directories.')
 parser.add_argument(
-    '-p, --preset', type=str, default='fast', choices=['ultra_fast', 'fast', 'standard', 'high_quality'], dest='preset',
+    '-p, --preset', type=str, default='fast', choices=['ultra_fast', 'fast', 'standard', 'high_quality', 'fast_dpm', 'standard_dpm', 'draft'], dest='preset',
     help='Which voice quality preset to use.')
 parser.add_argument(
     '-q, --quiet', default=False, action='store_true', dest='quiet',
@@ -91,6 +92,11 @@ tuning_group.add_argument(
     '--num-autoregressive-samples', type=int, default=None,
     help='Number of samples taken from the autoregressive model, all of which are filtered using CLVP. '
          'As TorToiSe is a probabilistic model, more samples means a higher probability of creating something "great".')
+tuning_group.add_argument(
+    '--min-autoregressive-samples', type=int, default=None,
+    help='Enables adaptive sampling: autoregressive samples are scored with CLVP batch by batch, and sampling stops early '
+         'once at least this many samples have been taken and the best scores have settled. '
+         '--num-autoregressive-samples becomes the upper limit.')
 tuning_group.add_argument(
     '--temperature', type=float, default=None,
     help='The softmax temperature of the autoregressive model.')
@@ -127,10 +133,42 @@ tuning_group.add_argument(
     help='Knob that determines how to balance the conditioning free signal with the conditioning-present signal. [0,inf]. '
          'As cond_free_k increases, the output becomes dominated by the conditioning-free signal. '
          'Formula is: output=cond_present_output*(cond_free_k+1)-cond_absenct_output*cond_free_k')
+tuning_group.add_argument(
+    '--cond-free-interval', type=float, nargs=2, default=None, metavar=('START', 'END'),
+    help='Only apply conditioning-free guidance while diffusion progress, from 1 (pure noise) to 0 (done), is within this '
+         'range. E.g. "0 0.6" skips the conditioning-free pass on the first 40%% of steps, where the ramped guidance is weak.')
+tuning_group.add_argument(
+    '--cond-free-every', type=int, default=None,
+    help='Only run the conditioning-free pass every this many diffusion steps, reusing its last output in between.')
+tuning_group.add_argument(
+    '--diffusion-cache-interval', type=int, default=None,
+    help='Only run the deep middle layers of the diffusion model every this many steps, reusing their output in between.')
+tuning_group.add_argument(
+    '--diffusion-convergence-tolerance', type=float, default=None,
+    help='Stop diffusing a clip early once its predicted spectrogram changes by less than this per step (e.g. 0.002).')
+tuning_group.add_argument(
+    '--diffusion-warm-start', type=float, default=None,
+    help='Start diffusion from the coarse spectrogram predicted from the codes, noised to this point of the process '
+         '(1 is pure noise), and only run that fraction of the diffusion steps.')
+tuning_group.add_argument(
+    '--diffusion-window', type=int, default=None,
+    help='Run the diffusion model over crossfaded windows of this many spectrogram frames (e.g. 512) to bound its '
+         'memory use on long clips.')
+tuning_group.add_argument(
+    '--diffusion-spacing', type=str, default=None,
+    help='Which timesteps the diffusion steps use: uniform, log_snr, or the name or path of a spacing made with '
+         'tortoise/calibrate_diffusion_steps.py, which then also decides the number of steps.')
+tuning_group.add_argument(
+    '--vocoder-chunk-size', type=int, default=None,
+    help='Vocode spectrograms this many frames at a time (e.g. 256) to bound the memory the vocoder takes on long clips.')
 tuning_group.add_argument(
     '--diffusion-temperature', type=float, default=None,
     help='Controls the variance of the noise fed into the diffusion model. [0,1]. Values at 0 '
          'are the "mean" prediction of the diffusion network and will sound bland and smeared. ')
+tuning_group.add_argument(
+    '--sampler', type=str, default=None, choices=['p', 'ddim', 'dpm++2m'],
+    help='How the diffusion process is sampled. "p" takes ancestral steps and needs 80+ diffusion iterations. '
+         '"ddim" and "dpm++2m" are ODE solvers that need only 10-30 iterations; "dpm++2m" is the more accurate.')
 
 usage_examples = f'''
 Examples:
@@ -194,6 +232,8 @@ else:
         parser.error('cannot have multiple voices without --output-dir"')
     if args.candidates > 1:
         parser.error('cannot have multiple candidates without --output-dir"')
+if args.play and args.candidates > 1:
+    parser.error('--play only plays a single candidate, so it cannot be used with --candidates above 1')
 
 # error out early if pydub isn't installed
 if args.play:
@@ -203,6 +243,32 @@ if args.play:
     except ImportError:
         parser.error('--play requires pydub to be installed, which can be done with "pip install pydub"')
 
+
+def play_stream(chunks):
+    """
+    Plays audio chunks from an iterator in order. Playback happens on a background thread so that the next chunk can be
+    generated while the current one is playing.
+    """
+    pending = queue.Queue()
+
+    def player():
+        while True:
+            audio = pending.get()
+            if audio is None:
+                return
+            pcm = (audio.squeeze().cpu().clamp(-1, 1) * 32767).short().numpy().tobytes()
+            pydub.playback.play(pydub.AudioSegment(data=pcm, sample_width=2, frame_rate=24000, channels=1))
+
+    thread = threading.Thread(target=player, daemon=True)
+    thread.start()
+    try:
+        for chunk in chunks:
+            pending.put(chunk)
+    finally:
+        pending.put(None)
+        thread.join()
+
+
 seed = int(time.time()) if args.seed is None else args.seed
 if not args.quiet:
     print('Loading tts...')
@@ -215,8 +281,11 @@ gen_settings = {
     'preset': args.preset,
 }
 tuning_options = [
-    'num_autoregressive_samples', 'temperature', 'length_penalty', 'repetition_penalty', 'top_p',
-    'max_mel_tokens', 'cvvp_amount', 'diffusion_iterations', 'cond_free', 'cond_free_k', 'diffusion_temperature']
+    'num_autoregressive_samples', 'min_autoregressive_samples', 'temperature', 'length_penalty', 'repetition_penalty', 'top_p',
+    'max_mel_tokens', 'cvvp_amount', 'diffusion_iterations', 'cond_free', 'cond_free_k', 'diffusion_temperature',
+    'sampler', 'cond_free_interval', 'cond_free_every', 'diffusion_cache_interval',
+    'diffusion_convergence_tolerance', 'diffusion_warm_start', 'diffusion_window',
+    'diffusion_spacing', 'vocoder_chunk_size']
 for option in tuning_options:
     if getattr(args, option) is not None:
         gen_settings[option] = getattr(args, option)
@@ -225,6 +294,19 @@ regenerate_clips = [int(x) for x in args.regenerate.split(',')] if args.regenera
 for voice_idx, voice in enumerate(selected_voices):
     audio_parts = []
     voice_samples, conditioning_latents = load_voices(voice, extra_voice_dirs)
+    if args.produce_debug_state:
+        os.makedirs('debug_states', exist_ok=True)
+        dbg_state = (seed, texts, voice_samples, conditioning_latents, args)
+        torch.save(dbg_state, os.path.join('debug_states', f'debug_{"-".join(voice)}.pth'))
+    if args.play and not args.output and not args.output_dir:
+        # Nothing is saved, so play each segment as soon as it is rendered while the following segments are still being generated.
+        def announce(text_idx, text, audio):
+            if not args.quiet:
+                print(f'Rendered segment {text_idx + 1} of {len(texts)}:')
+                print('  ' + text)
+        play_stream(tts.tts_stream(texts, voice_samples=voice_samples, conditioning_latents=conditioning_latents,
+                                   callback=announce, **gen_settings))
+        continue
     for text_idx, text in enumerate(texts):
         clip_name = f'{"-".join(voice)}_{text_idx:02d}'
         if args.output_dir:
@@ -255,12 +337,3 @@ for voice_idx, voice in enumerate(selected_voices):
     elif args.output:
         filename = args.output if args.output else os.tmp
         torchaudio.save(args.output, audio, 24000)
-    elif args.play:
-        f = tempfile.NamedTemporaryFile(suffix='.wav', delete=True)
-        torchaudio.save(f.name, audio, 24000)
-        pydub.playback.play(pydub.AudioSegment.from_wav(f.name))
-
-    if args.produce_debug_state:
-        os.makedirs('debug_states', exist_ok=True)
-        dbg_state = (seed, texts, voice_samples, conditioning_latents, args)
-        torch.save(dbg_state, os.path.join('debug_states', f'debug_{"-".join(voice)}.pth'))
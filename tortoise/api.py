@@ -1,3 +1,5 @@
+import functools
+import json
 import os
 import random
 import uuid
@@ -10,7 +12,7 @@ import progressbar
 import torchaudio
 
 from tortoise.models.classifier import AudioMiniEncoderWithClassifierHead
-from tortoise.models.diffusion_decoder import DiffusionTts
+from tortoise.models.diffusion_decoder import DiffusionTts, LayerCache, WindowedDiffusion
 from tortoise.models.autoregressive import UnifiedVoice
 from tqdm import tqdm
 from tortoise.models.arch_util import TorchMelSpectrogram
@@ -19,13 +21,17 @@ from tortoise.models.cvvp import CVVP
 from tortoise.models.random_latent_generator import RandomLatentConverter
 from tortoise.models.vocoder import UnivNetGenerator
 from tortoise.utils.audio import wav_to_univnet_mel, denormalize_tacotron_mel
-from tortoise.utils.diffusion import SpacedDiffusion, space_timesteps, get_named_beta_schedule
+from tortoise.utils.diffusion import SpacedDiffusion, ConvergenceMonitor, space_timesteps, space_timesteps_log_snr, \
+    get_named_beta_schedule
+from tortoise.utils.residency import ModelResidency
+from tortoise.utils.text import split_and_recombine_text
 from tortoise.utils.tokenizer import VoiceBpeTokenizer
 from tortoise.utils.wav2vec_alignment import Wav2VecAlignment
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 pbar = None
 
 DEFAULT_MODELS_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tortoise', 'models')
+DIFFUSION_SPACINGS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'diffusion_spacings')
 MODELS_DIR = os.environ.get('TORTOISE_MODELS_DIR', DEFAULT_MODELS_DIR)
 MODELS = {
     'autoregressive.pth': 'https://huggingface.co/jbetker/tortoise-tts-v2/resolve/main/.models/autoregressive.pth',
@@ -91,13 +97,62 @@ def pad_or_truncate(t, length):
         return t[..., :length]
 
 
-def load_discrete_vocoder_diffuser(trained_diffusion_steps=4000, desired_diffusion_steps=200, cond_free=True, cond_free_k=1):
+def save_timestep_spacing(name, timesteps, trained_diffusion_steps=4000, directory=DIFFUSION_SPACINGS_DIR, **info):
     """
-    Helper function to load a GaussianDiffusion instance configured for use as a vocoder.
+    Saves a set of timesteps of the trained diffusion process as a named spacing that load_discrete_vocoder_diffuser()
+    can load. Any extra keyword arguments are stored alongside, to record how the spacing was made. Returns the path
+    the spacing was saved to.
     """
-    return SpacedDiffusion(use_timesteps=space_timesteps(trained_diffusion_steps, [desired_diffusion_steps]), model_mean_type='epsilon',
-                           model_var_type='learned_range', loss_type='mse', betas=get_named_beta_schedule('linear', trained_diffusion_steps),
-                           conditioning_free=cond_free, conditioning_free_k=cond_free_k)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{name}.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'trained_diffusion_steps': trained_diffusion_steps, 'timesteps': sorted(int(t) for t in timesteps),
+                   **info}, f, indent=2)
+    return path
+
+
+def load_timestep_spacing(name, trained_diffusion_steps=4000):
+    """
+    Loads the timesteps of a spacing saved with save_timestep_spacing(). <name> is either the name of a spacing in
+    DIFFUSION_SPACINGS_DIR or the path to a spacing file.
+    """
+    path = name if name.endswith('.json') else os.path.join(DIFFUSION_SPACINGS_DIR, f'{name}.json')
+    if not os.path.exists(path):
+        available = sorted(f[:-len('.json')] for f in os.listdir(DIFFUSION_SPACINGS_DIR)
+                           if f.endswith('.json')) if os.path.isdir(DIFFUSION_SPACINGS_DIR) else []
+        raise ValueError(f'Unknown timestep spacing "{name}". Options are: uniform, log_snr'
+                         f'{"".join(", " + a for a in available)}, or the path to a spacing file.')
+    with open(path, 'r', encoding='utf-8') as f:
+        spacing = json.load(f)
+    if spacing['trained_diffusion_steps'] != trained_diffusion_steps:
+        raise ValueError(f'Timestep spacing "{name}" was made for a diffusion process of '
+                         f'{spacing["trained_diffusion_steps"]} steps, not {trained_diffusion_steps}.')
+    return set(spacing['timesteps'])
+
+
+@functools.lru_cache(maxsize=16)
+def load_discrete_vocoder_diffuser(trained_diffusion_steps=4000, desired_diffusion_steps=200, cond_free=True, cond_free_k=1,
+                                   timestep_spacing='uniform', cond_free_interval=None, cond_free_every=1):
+    """
+    Helper function to load a GaussianDiffusion instance configured for use as a vocoder. Instances are cached per set of
+    arguments, along with the schedule tensors they keep on each device they are used on (see device_schedule()).
+    :param timestep_spacing: 'uniform' keeps evenly spaced timesteps of the trained process, 'log_snr' keeps timesteps
+                             evenly spaced in log signal-to-noise ratio, which suits the few-step DDIM and DPM-Solver++
+                             samplers. Anything else names a spacing saved with save_timestep_spacing() (see
+                             load_timestep_spacing()), whose own number of steps replaces desired_diffusion_steps.
+    :param cond_free_interval: Optional (start, end) tuple; see GaussianDiffusion.
+    :param cond_free_every: See GaussianDiffusion.
+    """
+    betas = get_named_beta_schedule('linear', trained_diffusion_steps)
+    if timestep_spacing == 'uniform':
+        use_timesteps = space_timesteps(trained_diffusion_steps, [desired_diffusion_steps])
+    elif timestep_spacing == 'log_snr':
+        use_timesteps = space_timesteps_log_snr(betas, desired_diffusion_steps)
+    else:
+        use_timesteps = load_timestep_spacing(timestep_spacing, trained_diffusion_steps)
+    return SpacedDiffusion(use_timesteps=use_timesteps, model_mean_type='epsilon', model_var_type='learned_range',
+                           loss_type='mse', betas=betas, conditioning_free=cond_free, conditioning_free_k=cond_free_k,
+                           conditioning_free_interval=cond_free_interval, conditioning_free_every=cond_free_every)
 
 
 def format_conditioning(clip, cond_length=132300, device="cuda" if not torch.backends.mps.is_available() else 'mps'):
@@ -144,20 +199,140 @@ def fix_autoregressive_output(codes, stop_token, complain=True):
     return codes
 
 
-def do_spectrogram_diffusion(diffusion_model, diffuser, latents, conditioning_latents, temperature=1, verbose=True):
+def trim_latents_at_silence(codes, latents, calm_token=83):
+    """
+    Trims the autoregressive <latents> of a single (s,) sequence of <codes> at the first long run of "calm" tokens, which
+    code silence. The 8 tokens kept give the diffusion model some "breathing room" to terminate speech.
+    """
+    ctokens = 0
+    for k in range(codes.shape[-1]):
+        if codes[k] == calm_token:
+            ctokens += 1
+        else:
+            ctokens = 0
+        if ctokens > 8:
+            return latents[:k]
+    return latents
+
+
+DIFFUSION_SAMPLERS = ('p', 'ddim', 'dpm++2m')
+
+
+def do_spectrogram_diffusion(diffusion_model, diffuser, latents, conditioning_latents, temperature=1, verbose=True,
+                             sampler='p', layer_cache_interval=None, convergence_monitor=None, warm_start=None,
+                             window=None, window_overlap=64):
     """
     Uses the specified diffusion model to convert discrete codes into a spectrogram.
+
+    <sampler> selects how the reverse process is integrated: 'p' takes ancestral steps with p_sample_loop(), 'ddim' takes
+    deterministic DDIM steps and 'dpm++2m' uses the second order multistep DPM-Solver++.
+
+    <latents> is either a (b,s,c) tensor, or a list of (s,c) tensors of different lengths which are padded and diffused
+    together as one batch. In the latter case a list of spectrograms, each trimmed to the length of its own latents, is
+    returned. <conditioning_latents> is shared by the whole batch if it has a single row, otherwise it holds one row per
+    batch element.
+
+    When <layer_cache_interval> is set, the middle layers of the diffusion model only run on every
+    <layer_cache_interval>th step and their last output is reused on the steps between; see LayerCache.
+
+    A ConvergenceMonitor passed as <convergence_monitor> stops sampling each batch element once it has converged, and
+    afterwards holds the number of steps each one took. Padding is left out of its measurements.
+
+    When <warm_start> is set, diffusion starts from the coarse spectrogram that the diffusion model predicts from the
+    latents alone, noised as it would be at that fraction of the process (1 being pure noise), and only the remaining
+    steps are taken, as in SDEdit (Meng et al., 2021). With a <warm_start> of 0 no diffusion is done at all, and the
+    coarse spectrogram itself is returned.
+
+    When <window> is set, each step runs the diffusion model over windows of that many output frames, overlapping by
+    <window_overlap> frames, and crossfades the results; see WindowedDiffusion. This bounds the memory that diffusing
+    long sequences takes.
     """
     with torch.no_grad():
-        output_seq_len = latents.shape[1] * 4 * 24000 // 22050  # This diffusion model converts from 22kHz spectrogram codes to a 24kHz spectrogram signal.
-        output_shape = (latents.shape[0], 100, output_seq_len)
-        precomputed_embeddings = diffusion_model.timestep_independent(latents, conditioning_latents, output_seq_len, False)
+        if torch.is_tensor(latents):
+            latents = list(latents)
+            variable_length = False
+        else:
+            variable_length = True
+        # This diffusion model converts from 22kHz spectrogram codes to a 24kHz spectrogram signal.
+        output_seq_lens = [l.shape[0] * 4 * 24000 // 22050 for l in latents]
+        output_seq_len = max(output_seq_lens)
+        output_shape = (len(latents), 100, output_seq_len)
+        if conditioning_latents.shape[0] == 1:
+            conditioning_latents = conditioning_latents.expand(len(latents), *conditioning_latents.shape[1:])
+
+        # The timestep independent embeddings are computed for each element at its own length, then padded.
+        independent = [diffusion_model.timestep_independent(l.unsqueeze(0), c, length, warm_start is not None)
+                       for l, c, length in zip(latents, conditioning_latents.split(1), output_seq_lens)]
+        if warm_start is not None:
+            independent, code_preds = zip(*independent)
+        precomputed_embeddings = torch.cat([F.pad(e, (0, output_seq_len - e.shape[-1])) for e in independent], dim=0)
+        if warm_start is not None:
+            code_pred = torch.cat([F.pad(m, (0, output_seq_len - m.shape[-1])) for m in code_preds], dim=0).clamp(-1, 1)
+            if warm_start == 0:
+                # Nothing is left to diffuse; the coarse prediction is the spectrogram.
+                if convergence_monitor is not None:
+                    convergence_monitor.begin(len(latents), code_pred.device)
+                return _finish_spectrograms(code_pred, output_seq_lens, variable_length)
+
+        model_kwargs = {'precomputed_aligned_embeddings': precomputed_embeddings,
+                        'time_embedding_table': diffusion_model.precompute_time_embeddings(
+                            diffuser.device_schedule(precomputed_embeddings.device)['model_timesteps'])}
+        if min(output_seq_lens) != output_seq_len:
+            lengths = torch.tensor(output_seq_lens, device=precomputed_embeddings.device)
+            model_kwargs['mask'] = torch.arange(output_seq_len, device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)
+        if layer_cache_interval is not None and layer_cache_interval > 1:
+            model_kwargs['layer_cache'] = LayerCache(refresh_interval=layer_cache_interval)
+
+        noise = torch.randn(output_shape, device=precomputed_embeddings.device) * temperature
+        start_step = None
+        if warm_start is not None:
+            start_step = min(max(round(warm_start * diffuser.num_timesteps) - 1, 0), diffuser.num_timesteps - 1)
+            t = torch.full((len(latents),), start_step, device=noise.device, dtype=torch.long)
+            noise = diffuser.q_sample(code_pred, t, noise=noise)
+        if window is not None:
+            diffusion_model = WindowedDiffusion(diffusion_model, window, window_overlap)
+        if sampler == 'p' and convergence_monitor is None:
+            # Same samples as p_sample_loop(), with less allocator churn.
+            mel = diffuser.p_sample_loop_preallocated(diffusion_model, output_shape, noise=noise,
+                                                      model_kwargs=model_kwargs, progress=verbose, start_step=start_step)
+        else:
+            sample_loop = {'p': diffuser.p_sample_loop, 'ddim': diffuser.ddim_sample_loop,
+                           'dpm++2m': diffuser.dpm_solver_sample_loop}[sampler]
+            if convergence_monitor is not None:
+                convergence_monitor.mask = model_kwargs.get('mask')
+            mel = sample_loop(diffusion_model, output_shape, noise=noise, model_kwargs=model_kwargs, progress=verbose,
+                              convergence_monitor=convergence_monitor, start_step=start_step)
+        return _finish_spectrograms(mel, output_seq_lens, variable_length)
+
+
+def _finish_spectrograms(mel, output_seq_lens, variable_length):
+    """
+    Denormalizes the batch of spectrograms made by do_spectrogram_diffusion() and, for variable length inputs, splits
+    it into a list of spectrograms trimmed to their own lengths.
+    """
+    mel = denormalize_tacotron_mel(mel)
+    if not variable_length:
+        return mel
+    return [m[:, :length].unsqueeze(0) for m, length in zip(mel, output_seq_lens)]
 
-        noise = torch.randn(output_shape, device=latents.device) * temperature
-        mel = diffuser.p_sample_loop(diffusion_model, output_shape, noise=noise,
-                                      model_kwargs={'precomputed_aligned_embeddings': precomputed_embeddings},
-                                     progress=verbose)
-        return denormalize_tacotron_mel(mel)[:,:,:output_seq_len]
+
+def clvp_scores_settled(scores, k, batch_bests, margin=None, plateau_batches=None):
+    """
+    Decides whether enough autoregressive samples have been scored to stop sampling.
+
+    :param scores: CLVP scores of all samples taken so far.
+    :param k: Number of candidates that will be picked.
+    :param batch_bests: The k-th best score seen after each batch so far, latest last.
+    :param margin: Stop once the k-th best score is this many standard deviations above the mean score.
+    :param plateau_batches: Stop once the k-th best score has not improved for this many batches.
+    """
+    if margin is not None and scores.shape[0] > k:
+        kth_best = torch.topk(scores, k=k).values[-1]
+        if kth_best >= scores.mean() + margin * scores.std():
+            return True
+    if plateau_batches is not None and len(batch_bests) > plateau_batches:
+        return batch_bests[-1] <= batch_bests[-plateau_batches - 1]
+    return False
 
 
 def classify_audio_clip(clip):
@@ -208,7 +383,8 @@ class TextToSpeech:
 
     def __init__(self, autoregressive_batch_size=None, models_dir=MODELS_DIR, 
                  enable_redaction=True, kv_cache=False, use_deepspeed=False, half=False, device=None,
-                 tokenizer_vocab_file=None, tokenizer_basic=False):
+                 tokenizer_vocab_file=None, tokenizer_basic=False, residency='offload', memory_budget=None,
+                 native_ar_decoder=False, vocoder_lvc='einsum'):
 
         """
         Constructor
@@ -220,6 +396,14 @@ class TextToSpeech:
                                  (but are still rendered by the model). This can be used for prompt engineering.
                                  Default is true.
         :param device: Device to use when running the model. If omitted, the device will be automatically chosen.
+        :param residency: Which models are kept on the device between uses. 'offload' moves every model to the device only
+                          while it is used, 'resident' keeps models on the device once loaded and 'lru' keeps the most
+                          recently used models on the device within memory_budget. See ModelResidency.
+        :param memory_budget: Number of bytes of model weights the 'lru' residency policy may keep on the device.
+        :param native_ar_decoder: When true, autoregressive samples are generated by ARDecoder, which decodes with a
+                                  preallocated KV cache, instead of transformers' generate(). Takes precedence over kv_cache.
+        :param vocoder_lvc: How the vocoder computes its location-variable convolutions: 'einsum' or 'bmm'. 'bmm' gives
+                            the same audio and is about twice as fast on CPU. See LVCBlock.
         """
         self.models_dir = models_dir
         self.autoregressive_batch_size = pick_best_batch_size_for_gpu() if autoregressive_batch_size is None else autoregressive_batch_size
@@ -227,6 +411,8 @@ class TextToSpeech:
         self.device = torch.device('cuda' if torch.cuda.is_available() else'cpu')
         if torch.backends.mps.is_available():
             self.device = torch.device('mps')
+        self.residency = ModelResidency(self.device, policy=residency, memory_budget=memory_budget)
+        self.diffusion_steps_used = None  # Diffusion steps taken per candidate by the last tts() call stopping early.
         if self.enable_redaction:
             self.aligner = Wav2VecAlignment()
 
@@ -245,7 +431,8 @@ class TextToSpeech:
                                           heads=16, number_text_tokens=255, start_text_token=255, checkpointing=False,
                                           train_solo_embeddings=False).cpu().eval()
             self.autoregressive.load_state_dict(torch.load(get_model_path('autoregressive.pth', models_dir)), strict=False)
-            self.autoregressive.post_init_gpt2_config(use_deepspeed=use_deepspeed, kv_cache=kv_cache, half=self.half)
+            self.autoregressive.post_init_gpt2_config(use_deepspeed=use_deepspeed, kv_cache=kv_cache, half=self.half,
+                                                      native_decoder=native_ar_decoder)
             
             self.diffusion = DiffusionTts(model_channels=1024, num_layers=10, in_channels=100, out_channels=200,
                                           in_latent_channels=1024, in_tokens=8193, dropout=0, use_fp16=False, num_heads=16,
@@ -259,7 +446,7 @@ class TextToSpeech:
         self.clvp.load_state_dict(torch.load(get_model_path('clvp2.pth', models_dir)))
         self.cvvp = None # CVVP model is only loaded if used.
 
-        self.vocoder = UnivNetGenerator().cpu()
+        self.vocoder = UnivNetGenerator(lvc_implementation=vocoder_lvc).cpu()
         self.vocoder.load_state_dict(torch.load(get_model_path('vocoder.pth', models_dir), map_location=torch.device('cpu'))['model_g'])
         self.vocoder.eval(inference=True)
 
@@ -268,9 +455,11 @@ class TextToSpeech:
         self.rlg_diffusion = None
     @contextmanager
     def temporary_cuda(self, model):
-        m = model.to(self.device)
-        yield m
-        m = model.cpu()
+        m = self.residency.acquire(model)
+        try:
+            yield m
+        finally:
+            self.residency.release(model)
 
     
     def load_cvvp(self):
@@ -295,9 +484,8 @@ class TextToSpeech:
             for vs in voice_samples:
                 auto_conds.append(format_conditioning(vs, device=self.device))
             auto_conds = torch.stack(auto_conds, dim=1)
-            self.autoregressive = self.autoregressive.to(self.device)
-            auto_latent = self.autoregressive.get_conditioning(auto_conds)
-            self.autoregressive = self.autoregressive.cpu()
+            with self.temporary_cuda(self.autoregressive) as autoregressive:
+                auto_latent = autoregressive.get_conditioning(auto_conds)
 
             diffusion_conds = []
             for sample in voice_samples:
@@ -308,9 +496,8 @@ class TextToSpeech:
                 diffusion_conds.append(cond_mel)
             diffusion_conds = torch.stack(diffusion_conds, dim=1)
 
-            self.diffusion = self.diffusion.to(self.device)
-            diffusion_latent = self.diffusion.get_conditioning(diffusion_conds)
-            self.diffusion = self.diffusion.cpu()
+            with self.temporary_cuda(self.diffusion) as diffusion:
+                diffusion_latent = diffusion.get_conditioning(diffusion_conds)
 
         if return_mels:
             return auto_latent, diffusion_latent, auto_conds, diffusion_conds
@@ -327,6 +514,25 @@ class TextToSpeech:
         with torch.no_grad():
             return self.rlg_auto(torch.tensor([0.0])), self.rlg_diffusion(torch.tensor([0.0]))
 
+    def score_autoregressive_samples(self, clvp, text_tokens, codes, auto_conds=None, cvvp_amount=.0):
+        """
+        Fixes up a batch of autoregressive samples in place with fix_autoregressive_output() and returns how well each
+        of them matches the text according to CLVP, blended with the CVVP score by cvvp_amount.
+        """
+        for i in range(codes.shape[0]):
+            codes[i] = fix_autoregressive_output(codes[i], self.autoregressive.stop_mel_token)
+        if cvvp_amount != 1:
+            clvp_out = clvp(text_tokens.repeat(codes.shape[0], 1), codes, return_loss=False)
+        if auto_conds is not None and cvvp_amount > 0:
+            cvvp_accumulator = 0
+            for cl in range(auto_conds.shape[1]):
+                cvvp_accumulator = cvvp_accumulator + self.cvvp(auto_conds[:, cl].repeat(codes.shape[0], 1, 1), codes, return_loss=False)
+            cvvp = cvvp_accumulator / auto_conds.shape[1]
+            if cvvp_amount == 1:
+                return cvvp
+            return cvvp * cvvp_amount + clvp_out * (1-cvvp_amount)
+        return clvp_out
+
     def tts_with_preset(self, text, preset='fast', **kwargs):
         """
         Calls TTS with one of a set of preset generation parameters. Options:
@@ -334,30 +540,85 @@ class TextToSpeech:
             'fast': Decent quality speech at a decent inference rate. A good choice for mass inference.
             'standard': Very good quality. This is generally about as good as you are going to get.
             'high_quality': Use if you want the absolute best. This is not really worth the compute, though.
+            'fast_dpm', 'standard_dpm': 'fast' and 'standard' with the DPM-Solver++ diffusion sampler, which takes 20 and
+                                        30 diffusion steps instead of 80 and 200.
+            'draft': Skips diffusion and vocodes the diffusion model's coarse spectrogram prediction directly. Rough, but
+                     almost instant; meant for previews and checking the autoregressive output. Pass a small
+                     diffusion_warm_start (e.g. .1 for 3 of the 30 diffusion_iterations) to add a few refinement steps.
         """
         # Use generally found best tuning knobs for generation.
         settings = {'temperature': .8, 'length_penalty': 1.0, 'repetition_penalty': 2.0,
                     'top_p': .8,
-                    'cond_free_k': 2.0, 'diffusion_temperature': 1.0}
+                    'cond_free_k': 2.0, 'diffusion_temperature': 1.0, 'cond_free_interval': None, 'cond_free_every': 1,
+                    'diffusion_cache_interval': None, 'diffusion_convergence_tolerance': None,
+                    'diffusion_warm_start': None, 'diffusion_window': None, 'diffusion_spacing': None,
+                    'vocoder_chunk_size': None}
         # Presets are defined here.
         presets = {
             'ultra_fast': {'num_autoregressive_samples': 16, 'diffusion_iterations': 30, 'cond_free': False},
             'fast': {'num_autoregressive_samples': 96, 'diffusion_iterations': 80},
             'standard': {'num_autoregressive_samples': 256, 'diffusion_iterations': 200},
             'high_quality': {'num_autoregressive_samples': 256, 'diffusion_iterations': 400},
+            'fast_dpm': {'num_autoregressive_samples': 96, 'diffusion_iterations': 20, 'sampler': 'dpm++2m'},
+            'standard_dpm': {'num_autoregressive_samples': 256, 'diffusion_iterations': 30, 'sampler': 'dpm++2m'},
+            'draft': {'num_autoregressive_samples': 16, 'diffusion_iterations': 30, 'cond_free': False,
+                      'diffusion_warm_start': 0},
         }
         settings.update(presets[preset])
         settings.update(kwargs) # allow overriding of preset settings with kwargs
         return self.tts(text, **settings)
 
+    def tts_stream(self, text, preset='fast', voice_samples=None, conditioning_latents=None, desired_length=200,
+                   max_length=300, callback=None, **kwargs):
+        """
+        Streaming version of tts_with_preset(). The text is broken into segments which are rendered one at a time, and the
+        audio for each segment is yielded as soon as it has been vocoded, so playback can start long before the full text
+        has been rendered.
+        :param text: Text to be spoken. Either a string, which is split with split_and_recombine_text(), or a list of
+                     already split segments.
+        :param preset: Generation preset, see tts_with_preset(). Extra kwargs override the preset settings and are
+                       forwarded to tts(). Only k=1 is supported.
+        :param desired_length: Desired segment length in characters, passed to split_and_recombine_text().
+        :param max_length: Maximum segment length in characters, passed to split_and_recombine_text().
+        :param callback: Optional callable invoked as callback(segment_index, segment_text, audio) as each segment
+                         becomes available, before it is yielded.
+        :return: A generator over 24kHz audio clips as torch tensors, one per text segment, in order.
+        """
+        assert kwargs.get('k', 1) == 1, 'tts_stream() only produces a single candidate per segment.'
+        if isinstance(text, str):
+            texts = split_and_recombine_text(text, desired_length, max_length)
+        else:
+            texts = list(text)
+
+        # Compute the conditioning latents once rather than once per segment. CVVP needs the raw voice clips, so they
+        # are only dropped when CVVP is disabled.
+        if voice_samples is not None and kwargs.get('cvvp_amount', 0) == 0:
+            conditioning_latents = self.get_conditioning_latents(voice_samples)
+            voice_samples = None
+
+        for i, segment in enumerate(texts):
+            audio = self.tts_with_preset(segment, preset=preset, voice_samples=voice_samples,
+                                         conditioning_latents=conditioning_latents, **kwargs)
+            if callback is not None:
+                callback(i, segment, audio)
+            yield audio
+
     def tts(self, text, voice_samples=None, conditioning_latents=None, k=1, verbose=True, use_deterministic_seed=None,
             return_deterministic_state=False,
             # autoregressive generation parameters follow
             num_autoregressive_samples=512, temperature=.8, length_penalty=1, repetition_penalty=2.0, top_p=.8, max_mel_tokens=500,
+            record_autoregressive_latents=False,
+            # adaptive sampling parameters follow
+            min_autoregressive_samples=None, clvp_stop_margin=2.0, clvp_plateau_batches=2,
             # CVVP parameters follow
             cvvp_amount=.0,
             # diffusion generation parameters follow
-            diffusion_iterations=100, cond_free=True, cond_free_k=2, diffusion_temperature=1.0,
+            diffusion_iterations=100, cond_free=True, cond_free_k=2, diffusion_temperature=1.0, sampler='p',
+            cond_free_interval=None, cond_free_every=1, diffusion_cache_interval=None,
+            diffusion_convergence_tolerance=None, diffusion_convergence_patience=3, diffusion_warm_start=None,
+            diffusion_window=None, diffusion_spacing=None,
+            # vocoder parameters follow
+            vocoder_chunk_size=None,
             **hf_generate_kwargs):
         """
         Produces an audio clip of the given text being spoken with the given reference voice.
@@ -381,6 +642,22 @@ class TextToSpeech:
                                  I was interested in the premise, but the results were not as good as I was hoping. This is off by default, but
                                  could use some tuning.
         :param typical_mass: The typical_mass parameter from the typical_sampling algorithm.
+        :param record_autoregressive_latents: When true, the latents the diffusion model is conditioned on are recorded while
+                                              sampling instead of being recomputed for the chosen candidates with a second
+                                              pass through the autoregressive model. This saves a full transformer pass at
+                                              the cost of keeping the latents of every sample in memory until CLVP has picked
+                                              the best ones. See UnifiedVoice.inference_speech() for how the recorded latents
+                                              can differ from the recomputed ones.
+        ~~ADAPTIVE SAMPLING KNOBS~~
+        :param min_autoregressive_samples: When set, sampling is adaptive: every batch of autoregressive samples is scored
+                                           with CLVP as soon as it is generated, and sampling stops once at least this many
+                                           samples have been taken and the scores have settled (see below), or once
+                                           num_autoregressive_samples have been taken. The autoregressive model and CLVP
+                                           are both kept on the device while sampling.
+        :param clvp_stop_margin: Adaptive sampling stops once the k-th best CLVP score is this many standard deviations
+                                 above the mean of all scores so far. None disables this test.
+        :param clvp_plateau_batches: Adaptive sampling stops once the k-th best CLVP score has not improved for this many
+                                     batches. None disables this test.
         ~~CLVP-CVVP KNOBS~~
         :param cvvp_amount: Controls the influence of the CVVP model in selecting the best output from the autoregressive model.
                             [0,1]. Values closer to 1 mean the CVVP model is more important, 0 disables the CVVP model.
@@ -397,6 +674,43 @@ class TextToSpeech:
                             Formula is: output=cond_present_output*(cond_free_k+1)-cond_absenct_output*cond_free_k
         :param diffusion_temperature: Controls the variance of the noise fed into the diffusion model. [0,1]. Values at 0
                                       are the "mean" prediction of the diffusion network and will sound bland and smeared.
+        :param sampler: How the diffusion process is sampled. 'p' takes the ancestral steps the model was trained for and
+                        needs 80+ diffusion_iterations to sound good. 'ddim' (DDIM) and 'dpm++2m' (DPM-Solver++ 2M) are
+                        deterministic ODE solvers that get there in 10-30 iterations; they use timesteps spaced evenly in
+                        log signal-to-noise ratio. 'dpm++2m' is the more accurate of the two.
+        :param cond_free_interval: Optional (start, end) range of diffusion progress, from 1 (pure noise) to 0 (done),
+                                   outside of which conditioning-free guidance is skipped. The guidance is ramped in from
+                                   almost nothing at the start anyway, so e.g. (0, .6) saves the conditioning-free pass on
+                                   the first 40% of steps at little cost.
+        :param cond_free_every: Only run the conditioning-free pass every this many steps, blending in its last output on
+                                the steps between. 2 halves the number of conditioning-free passes.
+        :param diffusion_cache_interval: When set above 1, the deep middle layers of the diffusion model are only run on
+                                         every this many steps and their contribution is reused on the steps between,
+                                         which makes those steps several times cheaper. 2-3 costs little quality.
+        :param diffusion_convergence_tolerance: When set, diffusion of each candidate stops early once the mean absolute
+                                                change of its predicted (normalized) spectrogram has stayed below this
+                                                for diffusion_convergence_patience steps, and jumps to that prediction.
+                                                The steps taken per candidate are printed when verbose, and kept in
+                                                self.diffusion_steps_used. Around .002 suits the 'p' sampler.
+        :param diffusion_convergence_patience: See diffusion_convergence_tolerance.
+        :param diffusion_warm_start: When set, diffusion starts from the diffusion model's own coarse spectrogram
+                                     prediction for the chosen codes, noised to this point of the process (from 1,
+                                     pure noise, to 0), and only that fraction of diffusion_iterations is run. E.g. .5
+                                     halves the diffusion work; lower values trade detail for speed, which suits
+                                     drafts and retakes. 0 skips diffusion and vocodes the coarse prediction as is.
+        :param diffusion_window: When set, the diffusion model runs over overlapping windows of this many spectrogram
+                                 frames (~94 per second) that are crossfaded together, instead of attending over the
+                                 whole clip at once. This keeps the memory diffusion takes bounded for long clips.
+                                 512 works well.
+        :param diffusion_spacing: Which timesteps of the trained diffusion process the diffusion_iterations steps use.
+                                  By default 'uniform' (evenly spaced) for the 'p' sampler and 'log_snr' for the others.
+                                  Can also name a spacing searched for with calibrate_diffusion_steps.py, in which case
+                                  that spacing decides the number of steps.
+        ~~VOCODER KNOBS~~
+        :param vocoder_chunk_size: When set, the vocoder turns spectrograms into audio this many frames at a time, each
+                                   chunk with enough surrounding frames to come out the same as vocoding the whole
+                                   clip at once. This keeps the memory the vocoder takes bounded for long clips.
+                                   See UnivNetGenerator.inference_chunks().
         ~~OTHER STUFF~~
         :param hf_generate_kwargs: The huggingface Transformers generate API is used for the autoregressive transformer.
                                    Extra keyword args fed to this function get forwarded directly to that API. Documentation
@@ -405,6 +719,7 @@ class TextToSpeech:
                  Sample rate is 24kHz.
         """
         deterministic_seed = self.deterministic_state(seed=use_deterministic_seed)
+        self.residency.reset_counters()
 
         text_tokens = torch.IntTensor(self.tokenizer.encode(text)).unsqueeze(0).to(self.device)
         text_tokens = F.pad(text_tokens, (0, 1))  # This may not be necessary.
@@ -419,191 +734,153 @@ class TextToSpeech:
         auto_conditioning = auto_conditioning.to(self.device)
         diffusion_conditioning = diffusion_conditioning.to(self.device)
 
-        diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=diffusion_iterations, cond_free=cond_free, cond_free_k=cond_free_k)
+        if sampler not in DIFFUSION_SAMPLERS:
+            raise ValueError(f'Unknown sampler "{sampler}". Options are: {", ".join(DIFFUSION_SAMPLERS)}.')
+        diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=diffusion_iterations, cond_free=cond_free, cond_free_k=cond_free_k,
+                                                  timestep_spacing=diffusion_spacing or ('uniform' if sampler == 'p' else 'log_snr'),
+                                                  cond_free_interval=tuple(cond_free_interval) if cond_free_interval else None,
+                                                  cond_free_every=cond_free_every)
 
         with torch.no_grad():
             samples = []
+            sample_latents = []
+            clip_results = []
             num_batches = num_autoregressive_samples // self.autoregressive_batch_size
             stop_mel_token = self.autoregressive.stop_mel_token
             calm_token = 83  # This is the token for coding silence, which is fixed in place with "fix_autoregressive_output"
+            adaptive = min_autoregressive_samples is not None
+            autocast = dict(device_type="cuda", dtype=torch.float16, enabled=self.half and not torch.backends.mps.is_available())
+
+            def sample_batch(autoregressive):
+                generated = autoregressive.inference_speech(auto_conditioning, text_tokens,
+                                                            do_sample=True,
+                                                            top_p=top_p,
+                                                            temperature=temperature,
+                                                            num_return_sequences=self.autoregressive_batch_size,
+                                                            length_penalty=length_penalty,
+                                                            repetition_penalty=repetition_penalty,
+                                                            max_generate_length=max_mel_tokens,
+                                                            return_latent=record_autoregressive_latents,
+                                                            latent_dtype=torch.float16 if self.half else None,
+                                                            **hf_generate_kwargs)
+                codes = generated[0] if record_autoregressive_latents else generated
+                padding_needed = max_mel_tokens - codes.shape[1]
+                codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
+                samples.append(codes)
+                if record_autoregressive_latents:
+                    # Codes are padded out with the stop token; pad the latents to match by repeating the last one.
+                    latents = generated[1]
+                    latents = torch.cat([latents, latents[:, -1:].expand(-1, padding_needed, -1)], dim=1)
+                    sample_latents.append(latents)
+
+            if cvvp_amount > 0 and self.cvvp is None:
+                self.load_cvvp()
             if verbose:
-                print("Generating autoregressive samples..")
-            if not torch.backends.mps.is_available():
-                with self.temporary_cuda(self.autoregressive
-                ) as autoregressive, torch.autocast(device_type="cuda", dtype=torch.float16, enabled=self.half):
+                if cvvp_amount == 0:
+                    scoring = "CLVP"
+                else:
+                    scoring = f"CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%"
+                if adaptive:
+                    print(f"Generating autoregressive samples and scoring them using {scoring}..")
+                else:
+                    print("Generating autoregressive samples..")
+
+            # CVVP, when used, is kept on the device alongside CLVP for score_autoregressive_samples().
+            cvvp_residency = self.temporary_cuda(self.cvvp) if cvvp_amount > 0 else nullcontext()
+            if adaptive:
+                batch_bests = []
+                with self.temporary_cuda(self.autoregressive) as autoregressive, self.temporary_cuda(
+                    self.clvp
+                ) as clvp, cvvp_residency, torch.autocast(**autocast):
                     for b in tqdm(range(num_batches), disable=not verbose):
-                        codes = autoregressive.inference_speech(auto_conditioning, text_tokens,
-                                                                    do_sample=True,
-                                                                    top_p=top_p,
-                                                                    temperature=temperature,
-                                                                    num_return_sequences=self.autoregressive_batch_size,
-                                                                    length_penalty=length_penalty,
-                                                                    repetition_penalty=repetition_penalty,
-                                                                    max_generate_length=max_mel_tokens,
-                                                                    **hf_generate_kwargs)
-                        padding_needed = max_mel_tokens - codes.shape[1]
-                        codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
-                        samples.append(codes)
+                        sample_batch(autoregressive)
+                        clip_results.append(self.score_autoregressive_samples(clvp, text_tokens, samples[-1], auto_conds, cvvp_amount))
+                        scores = torch.cat(clip_results, dim=0)
+                        batch_bests.append(torch.topk(scores, k=min(k, scores.shape[0])).values[-1].item())
+                        if scores.shape[0] >= min_autoregressive_samples and \
+                                clvp_scores_settled(scores, k, batch_bests, clvp_stop_margin, clvp_plateau_batches):
+                            break
+                    if getattr(autoregressive, 'native_decoder', None) is not None:
+                        autoregressive.native_decoder.release()
+                if verbose:
+                    print(f"Took {len(samples) * self.autoregressive_batch_size} of at most "
+                          f"{num_batches * self.autoregressive_batch_size} autoregressive samples.")
             else:
-                with self.temporary_cuda(self.autoregressive) as autoregressive:
+                with self.temporary_cuda(self.autoregressive) as autoregressive, torch.autocast(**autocast):
                     for b in tqdm(range(num_batches), disable=not verbose):
-                        codes = autoregressive.inference_speech(auto_conditioning, text_tokens,
-                                                                    do_sample=True,
-                                                                    top_p=top_p,
-                                                                    temperature=temperature,
-                                                                    num_return_sequences=self.autoregressive_batch_size,
-                                                                    length_penalty=length_penalty,
-                                                                    repetition_penalty=repetition_penalty,
-                                                                    max_generate_length=max_mel_tokens,
-                                                                    **hf_generate_kwargs)
-                        padding_needed = max_mel_tokens - codes.shape[1]
-                        codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
-                        samples.append(codes)
+                        sample_batch(autoregressive)
+                    if getattr(autoregressive, 'native_decoder', None) is not None:
+                        autoregressive.native_decoder.release()
 
-            clip_results = []
-            
-            if not torch.backends.mps.is_available():
-                with self.temporary_cuda(self.clvp) as clvp, torch.autocast(
-                    device_type="cuda" if not torch.backends.mps.is_available() else 'mps', dtype=torch.float16, enabled=self.half
-                ):
-                    if cvvp_amount > 0:
-                        if self.cvvp is None:
-                            self.load_cvvp()
-                        self.cvvp = self.cvvp.to(self.device)
-                    if verbose:
-                        if self.cvvp is None:
-                            print("Computing best candidates using CLVP")
-                        else:
-                            print(f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%")
+                if verbose:
+                    print(f"Computing best candidates using {scoring}")
+                with self.temporary_cuda(self.clvp) as clvp, cvvp_residency, torch.autocast(**autocast):
                     for batch in tqdm(samples, disable=not verbose):
-                        for i in range(batch.shape[0]):
-                            batch[i] = fix_autoregressive_output(batch[i], stop_mel_token)
-                        if cvvp_amount != 1:
-                            clvp_out = clvp(text_tokens.repeat(batch.shape[0], 1), batch, return_loss=False)
-                        if auto_conds is not None and cvvp_amount > 0:
-                            cvvp_accumulator = 0
-                            for cl in range(auto_conds.shape[1]):
-                                cvvp_accumulator = cvvp_accumulator + self.cvvp(auto_conds[:, cl].repeat(batch.shape[0], 1, 1), batch, return_loss=False)
-                            cvvp = cvvp_accumulator / auto_conds.shape[1]
-                            if cvvp_amount == 1:
-                                clip_results.append(cvvp)
-                            else:
-                                clip_results.append(cvvp * cvvp_amount + clvp_out * (1-cvvp_amount))
-                        else:
-                            clip_results.append(clvp_out)
-                    clip_results = torch.cat(clip_results, dim=0)
-                    samples = torch.cat(samples, dim=0)
-                    best_results = samples[torch.topk(clip_results, k=k).indices]
-            else:
-                with self.temporary_cuda(self.clvp) as clvp:
-                    if cvvp_amount > 0:
-                        if self.cvvp is None:
-                            self.load_cvvp()
-                        self.cvvp = self.cvvp.to(self.device)
-                    if verbose:
-                        if self.cvvp is None:
-                            print("Computing best candidates using CLVP")
-                        else:
-                            print(f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%")
-                    for batch in tqdm(samples, disable=not verbose):
-                        for i in range(batch.shape[0]):
-                            batch[i] = fix_autoregressive_output(batch[i], stop_mel_token)
-                        if cvvp_amount != 1:
-                            clvp_out = clvp(text_tokens.repeat(batch.shape[0], 1), batch, return_loss=False)
-                        if auto_conds is not None and cvvp_amount > 0:
-                            cvvp_accumulator = 0
-                            for cl in range(auto_conds.shape[1]):
-                                cvvp_accumulator = cvvp_accumulator + self.cvvp(auto_conds[:, cl].repeat(batch.shape[0], 1, 1), batch, return_loss=False)
-                            cvvp = cvvp_accumulator / auto_conds.shape[1]
-                            if cvvp_amount == 1:
-                                clip_results.append(cvvp)
-                            else:
-                                clip_results.append(cvvp * cvvp_amount + clvp_out * (1-cvvp_amount))
-                        else:
-                            clip_results.append(clvp_out)
-                    clip_results = torch.cat(clip_results, dim=0)
-                    samples = torch.cat(samples, dim=0)
-                    best_results = samples[torch.topk(clip_results, k=k).indices]
-            if self.cvvp is not None:
-                self.cvvp = self.cvvp.cpu()
+                        clip_results.append(self.score_autoregressive_samples(clvp, text_tokens, batch, auto_conds, cvvp_amount))
+
+            clip_results = torch.cat(clip_results, dim=0)
+            samples = torch.cat(samples, dim=0)
+            best_indices = torch.topk(clip_results, k=k).indices
+            best_results = samples[best_indices]
             del samples
 
             # The diffusion model actually wants the last hidden layer from the autoregressive model as conditioning
-            # inputs. Re-produce those for the top results. This could be made more efficient by storing all of these
-            # results, but will increase memory usage.
-            if not torch.backends.mps.is_available():
-                with self.temporary_cuda(
-                    self.autoregressive
-                ) as autoregressive, torch.autocast(
-                    device_type="cuda" if not torch.backends.mps.is_available() else 'mps', dtype=torch.float16, enabled=self.half
-                ):
-                    best_latents = autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
-                                                    torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), best_results,
-                                                    torch.tensor([best_results.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
-                                                    return_latent=True, clip_inputs=False)
-                    del auto_conditioning
+            # inputs. Unless they were recorded while sampling, re-produce those for the top results.
+            if record_autoregressive_latents:
+                best_latents = torch.cat(sample_latents, dim=0)[best_indices].float()
+                del sample_latents
             else:
-                with self.temporary_cuda(
-                    self.autoregressive
-                ) as autoregressive:
+                with self.temporary_cuda(self.autoregressive) as autoregressive, torch.autocast(**autocast):
                     best_latents = autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
-                                                    torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), best_results,
-                                                    torch.tensor([best_results.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
-                                                    return_latent=True, clip_inputs=False)
-                    del auto_conditioning
+                                                  torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), best_results,
+                                                  torch.tensor([best_results.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
+                                                  return_latent=True, clip_inputs=False)
+            del auto_conditioning
 
             if verbose:
                 print("Transforming autoregressive outputs into audio..")
-            wav_candidates = []
+            # Trim each candidate at the first long silence, then diffuse all of them together as one batch.
+            best_latents = [trim_latents_at_silence(codes, latents, calm_token)
+                            for codes, latents in zip(best_results, best_latents)]
+            convergence_monitor = None
+            if diffusion_convergence_tolerance is not None:
+                convergence_monitor = ConvergenceMonitor(diffusion_convergence_tolerance, diffusion_convergence_patience)
             if not torch.backends.mps.is_available():
                 with self.temporary_cuda(self.diffusion) as diffusion, self.temporary_cuda(
                     self.vocoder
                 ) as vocoder:
-                    for b in range(best_results.shape[0]):
-                        codes = best_results[b].unsqueeze(0)
-                        latents = best_latents[b].unsqueeze(0)
-
-                        # Find the first occurrence of the "calm" token and trim the codes to that.
-                        ctokens = 0
-                        for k in range(codes.shape[-1]):
-                            if codes[0, k] == calm_token:
-                                ctokens += 1
-                            else:
-                                ctokens = 0
-                            if ctokens > 8:  # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
-                                latents = latents[:, :k]
-                                break
-                        mel = do_spectrogram_diffusion(diffusion, diffuser, latents, diffusion_conditioning, temperature=diffusion_temperature, 
-                                                    verbose=verbose)
-                        wav = vocoder.inference(mel)
-                        wav_candidates.append(wav.cpu())
+                    mels = do_spectrogram_diffusion(diffusion, diffuser, best_latents, diffusion_conditioning,
+                                                    temperature=diffusion_temperature, verbose=verbose, sampler=sampler,
+                                                    layer_cache_interval=diffusion_cache_interval,
+                                                    convergence_monitor=convergence_monitor,
+                                                    warm_start=diffusion_warm_start, window=diffusion_window)
+                    wav_candidates = [wav.cpu() for wav in vocoder.inference_batch(mels, chunk_size=vocoder_chunk_size)]
             else:
                 diffusion, vocoder = self.diffusion, self.vocoder
-                diffusion_conditioning = diffusion_conditioning.cpu()
-                for b in range(best_results.shape[0]):
-                    codes = best_results[b].unsqueeze(0).cpu()
-                    latents = best_latents[b].unsqueeze(0).cpu()
-
-                    # Find the first occurrence of the "calm" token and trim the codes to that.
-                    ctokens = 0
-                    for k in range(codes.shape[-1]):
-                        if codes[0, k] == calm_token:
-                            ctokens += 1
-                        else:
-                            ctokens = 0
-                        if ctokens > 8:  # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
-                            latents = latents[:, :k]
-                            break
-                    mel = do_spectrogram_diffusion(diffusion, diffuser, latents, diffusion_conditioning, temperature=diffusion_temperature, 
-                                                verbose=verbose)
-                    wav = vocoder.inference(mel)
-                    wav_candidates.append(wav.cpu())
+                # The diffusion model and vocoder are run on the CPU here.
+                self.residency.evict(diffusion)
+                self.residency.evict(vocoder)
+                mels = do_spectrogram_diffusion(diffusion, diffuser, [l.cpu() for l in best_latents],
+                                                diffusion_conditioning.cpu(), temperature=diffusion_temperature,
+                                                verbose=verbose, sampler=sampler,
+                                                layer_cache_interval=diffusion_cache_interval,
+                                                convergence_monitor=convergence_monitor,
+                                                warm_start=diffusion_warm_start, window=diffusion_window)
+                wav_candidates = [wav.cpu() for wav in vocoder.inference_batch(mels, chunk_size=vocoder_chunk_size)]
 
             def potentially_redact(clip, text):
                 if self.enable_redaction:
                     return self.aligner.redact(clip.squeeze(1), text).unsqueeze(1)
                 return clip
             wav_candidates = [potentially_redact(wav_candidate, text) for wav_candidate in wav_candidates]
+            if convergence_monitor is not None:
+                self.diffusion_steps_used = convergence_monitor.steps.tolist()
+                if verbose:
+                    print(f"Diffusion took {', '.join(str(n) for n in self.diffusion_steps_used)} of "
+                          f"{diffuser.num_timesteps} steps.")
+            if verbose:
+                print(f"Moved {self.residency.bytes_to_device / 1024 ** 2:.1f}MB of model weights to the device and "
+                      f"{self.residency.bytes_to_host / 1024 ** 2:.1f}MB back to the host.")
 
             if len(wav_candidates) > 1:
                 res = wav_candidates
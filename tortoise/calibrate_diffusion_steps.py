@@ -0,0 +1,152 @@
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from api import TextToSpeech, MODELS_DIR, DIFFUSION_SAMPLERS, DIFFUSION_SPACINGS_DIR, do_spectrogram_diffusion, \
+    fix_autoregressive_output, save_timestep_spacing, trim_latents_at_silence
+from utils.audio import load_voices
+from utils.diffusion import SpacedDiffusion, get_named_beta_schedule, space_timesteps, space_timesteps_log_snr
+
+"""
+Searches for the subset of the trained diffusion timesteps that, for a given budget of steps, comes closest to what many
+more steps produce, and saves it as a named spacing that TextToSpeech.tts() and load_discrete_vocoder_diffuser() can use
+with diffusion_spacing=<name>.
+
+Closeness is the mean L1 distance between spectrograms of a set of reference clips, decoded from the same noise with the
+candidate spacing and with a high-step reference. The deterministic 'ddim' and 'dpm++2m' samplers give the most reliable
+results, as for them the same noise means the same trajectory.
+"""
+
+
+def make_diffuser(timesteps, trained_diffusion_steps=4000, cond_free=True, cond_free_k=2.0):
+    return SpacedDiffusion(use_timesteps=set(timesteps), model_mean_type='epsilon', model_var_type='learned_range',
+                           loss_type='mse', betas=get_named_beta_schedule('linear', trained_diffusion_steps),
+                           conditioning_free=cond_free, conditioning_free_k=cond_free_k)
+
+
+def record_reference_latents(tts, texts, voice_samples=None, conditioning_latents=None):
+    """
+    Takes one autoregressive sample for each of <texts> and returns the latents the diffusion model is conditioned on,
+    one (s,c) tensor per text, along with the diffusion conditioning latent of the voice.
+    """
+    if voice_samples is not None:
+        auto_conditioning, diffusion_conditioning = tts.get_conditioning_latents(voice_samples)
+    elif conditioning_latents is not None:
+        auto_conditioning, diffusion_conditioning = conditioning_latents
+    else:
+        auto_conditioning, diffusion_conditioning = tts.get_random_conditioning_latents()
+    auto_conditioning = auto_conditioning.to(tts.device)
+    references = []
+    with torch.no_grad(), tts.temporary_cuda(tts.autoregressive) as autoregressive:
+        for text in texts:
+            text_tokens = F.pad(torch.IntTensor(tts.tokenizer.encode(text)).unsqueeze(0).to(tts.device), (0, 1))
+            codes = autoregressive.inference_speech(auto_conditioning, text_tokens, do_sample=True, top_p=.8,
+                                                    temperature=.8, num_return_sequences=1, length_penalty=1,
+                                                    repetition_penalty=2.0, max_generate_length=500)
+            codes = fix_autoregressive_output(codes[0], autoregressive.stop_mel_token).unsqueeze(0)
+            latents = autoregressive(auto_conditioning, text_tokens,
+                                     torch.tensor([text_tokens.shape[-1]], device=tts.device), codes,
+                                     torch.tensor([codes.shape[-1] * autoregressive.mel_length_compression],
+                                                  device=tts.device),
+                                     return_latent=True, clip_inputs=False)
+            references.append(trim_latents_at_silence(codes[0], latents[0]).cpu())
+    return references, diffusion_conditioning.cpu()
+
+
+def decode(diffusion, diffuser, latents, conditioning, sampler, seed):
+    torch.manual_seed(seed)
+    return do_spectrogram_diffusion(diffusion, diffuser, latents, conditioning, verbose=False, sampler=sampler)
+
+
+def search_timesteps(evaluate, timesteps, max_evaluations=150, verbose=True):
+    """
+    Searches for the sorted list of timesteps, starting from <timesteps>, for which evaluate() returns the lowest value.
+    The search is a coordinate descent: each timestep but the first and last is in turn moved part of the way towards
+    one of its neighbours, and the move is kept if it helps. Whenever a full pass over the timesteps brings no
+    improvement, the fraction of the way they are moved is halved. Returns the best timesteps and their value.
+    """
+    best = sorted(timesteps)
+    best_distance = evaluate(best)
+    evaluations = 1
+    fraction = .5
+    while evaluations < max_evaluations and fraction * max(b - a for a, b in zip(best, best[1:])) >= 1:
+        improved = False
+        for j in range(1, len(best) - 1):
+            for neighbour in (best[j - 1], best[j + 1]):
+                moved = best[j] + round(fraction * (neighbour - best[j]))
+                if moved in best or evaluations >= max_evaluations:
+                    continue
+                candidate = best[:j] + [moved] + best[j + 1:]
+                distance = evaluate(candidate)
+                evaluations += 1
+                if distance < best_distance:
+                    best, best_distance, improved = candidate, distance, True
+                    if verbose:
+                        print(f'{evaluations} evaluations: distance {distance:.5f}')
+                    break
+        if not improved:
+            fraction /= 2
+    return best, best_distance
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, help='Number of diffusion steps to find a spacing for.', default=30)
+    parser.add_argument('--reference_steps', type=int, help='Number of diffusion steps of the reference.', default=200)
+    parser.add_argument('--sampler', type=str, help='Diffusion sampler to calibrate for.', default='dpm++2m',
+                        choices=DIFFUSION_SAMPLERS)
+    parser.add_argument('--cond_free_k', type=float, help='Conditioning-free guidance strength to calibrate with.', default=2.0)
+    parser.add_argument('--voice', type=str, help='Voice to take the reference clips in.', default='random')
+    parser.add_argument('--text', type=str, action='append', help='Text of a reference clip. Can be given several times.')
+    parser.add_argument('--latents', type=str, help='Reference latents saved with --save_latents, used instead of '
+                                                    'sampling new ones for --text.', default=None)
+    parser.add_argument('--save_latents', type=str, help='Where to save the sampled reference latents.', default=None)
+    parser.add_argument('--max_evaluations', type=int, help='Number of candidate spacings to try at most.', default=150)
+    parser.add_argument('--name', type=str, help='Name to save the spacing under. Defaults to <sampler>_<steps>.', default=None)
+    parser.add_argument('--output_dir', type=str, help='Where to save the spacing.', default=DIFFUSION_SPACINGS_DIR)
+    parser.add_argument('--seed', type=int, help='Random seed of the diffusion noise.', default=0)
+    parser.add_argument('--model_dir', type=str, help='Where to find pretrained model checkpoints. Tortoise automatically downloads these to .models, so this'
+                                                      'should only be specified if you have custom checkpoints.', default=MODELS_DIR)
+    args = parser.parse_args()
+
+    tts = TextToSpeech(models_dir=args.model_dir)
+    if args.latents is not None:
+        references, conditioning = torch.load(args.latents)
+    else:
+        texts = args.text or ['The expressiveness of autoregressive transformers is literally nuts! I absolutely adore them.',
+                              'Thank you for calling. Please hold while we connect you to the next available agent.',
+                              'Yes.']
+        voice_samples, conditioning_latents = load_voices(args.voice.split('&'))
+        references, conditioning = record_reference_latents(tts, texts, voice_samples, conditioning_latents)
+        if args.save_latents is not None:
+            torch.save((references, conditioning), args.save_latents)
+    references = [latents.to(tts.device) for latents in references]
+    conditioning = conditioning.to(tts.device)
+
+    def default_spacing(count):
+        # The spacing tts() uses for the sampler.
+        if args.sampler == 'p':
+            return space_timesteps(4000, [count])
+        return space_timesteps_log_snr(get_named_beta_schedule('linear', 4000), count)
+
+    with tts.temporary_cuda(tts.diffusion) as diffusion:
+        targets = decode(diffusion, make_diffuser(default_spacing(args.reference_steps), cond_free_k=args.cond_free_k),
+                         references, conditioning, args.sampler, args.seed)
+
+        def evaluate(timesteps):
+            mels = decode(diffusion, make_diffuser(timesteps, cond_free_k=args.cond_free_k), references, conditioning,
+                          args.sampler, args.seed)
+            return sum((m - t).abs().mean().item() for m, t in zip(mels, targets)) / len(targets)
+
+        initial = default_spacing(args.steps)
+        initial_distance = evaluate(sorted(initial))
+        print(f'Default spacing: distance {initial_distance:.5f}')
+        timesteps, distance = search_timesteps(evaluate, initial, args.max_evaluations)
+
+    name = args.name or f'{args.sampler}_{args.steps}'
+    path = save_timestep_spacing(name, timesteps, directory=args.output_dir, sampler=args.sampler,
+                                 reference_steps=args.reference_steps, cond_free_k=args.cond_free_k,
+                                 mel_l1_distance=distance, default_mel_l1_distance=initial_distance)
+    print(f'Saved the spacing to {path}: distance {distance:.5f}, against {initial_distance:.5f} for the default. '
+          f'Use it with diffusion_spacing="{name}" and sampler="{args.sampler}".')
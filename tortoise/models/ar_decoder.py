@@ -0,0 +1,519 @@
+import math
+from time import time
+
+import torch
+import torch.nn.functional as F
+
+from tortoise.utils.typical_sampling import TypicalLogitsWarper
+
+
+def attention(q, k, v, mask=None, causal=False):
+    """
+    Scaled dot product attention over (b,h,s,d) tensors. <mask> is a boolean tensor that is True where attention is
+    allowed. Uses torch's fused scaled_dot_product_attention where it is available.
+    """
+    if hasattr(F, 'scaled_dot_product_attention'):
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask, is_causal=causal)
+    weights = q @ k.transpose(-1, -2) / math.sqrt(q.shape[-1])
+    if causal:
+        mask = torch.ones(q.shape[-2], k.shape[-2], dtype=torch.bool, device=q.device).tril(k.shape[-2] - q.shape[-2])
+    if mask is not None:
+        weights = weights.masked_fill(~mask, -float('inf'))
+    return weights.softmax(dim=-1).to(v.dtype) @ v
+
+
+def apply_repetition_penalty(scores, seen, penalty):
+    """
+    Penalizes the scores of the tokens marked in the boolean (b,vocab) tensor <seen> the way transformers'
+    RepetitionPenaltyLogitsProcessor does.
+    """
+    penalized = torch.where(scores < 0, scores * penalty, scores / penalty)
+    return torch.where(seen, penalized, scores)
+
+
+def warp_scores(scores, temperature=1.0, top_k=0, top_p=1.0):
+    """
+    Applies temperature, top-k and top-p (nucleus) filtering to <scores>, in that order and with the same semantics as
+    the corresponding transformers logits warpers.
+    """
+    if temperature != 1.0:
+        scores = scores / temperature
+    if top_k:
+        top_k = min(top_k, scores.shape[-1])
+        threshold = torch.topk(scores, top_k)[0][..., -1:]
+        scores = scores.masked_fill(scores < threshold, -float('inf'))
+    if top_p < 1.0:
+        sorted_scores, sorted_indices = torch.sort(scores, descending=False)
+        cumulative_probs = sorted_scores.softmax(dim=-1).cumsum(dim=-1)
+        sorted_to_remove = cumulative_probs <= (1 - top_p)
+        sorted_to_remove[..., -1:] = False
+        to_remove = sorted_to_remove.scatter(1, sorted_indices, sorted_to_remove)
+        scores = scores.masked_fill(to_remove, -float('inf'))
+    return scores
+
+
+class ARDecoder:
+    """
+    Samples mel codes from a UnifiedVoice without going through transformers' generate().
+
+    The key/value cache lives in two preallocated (layers,b,heads,s,head_dim) buffers that are written in place and
+    reused across calls as long as they are large enough, so decoding does not allocate a growing cache every step. The
+    GPT-2 blocks of the model are evaluated directly with its own weights, and sampling (repetition penalty, typical
+    sampling, temperature, top-k, top-p) is done here too.
+
+    Each mel token is placed at the position it has when the model is trained, so generation matches
+    UnifiedVoice.inference_speech() with the HF KV cache disabled. The HF KV cache path places every generated token one
+    position further along.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.blocks = model.gpt.h
+        self.ln_f = model.gpt.ln_f
+        self.heads = model.heads
+        self.head_dim = model.model_dim // model.heads
+        self.k_cache = None
+        self.v_cache = None
+
+    def reserve(self, batch_size, length, dtype, device):
+        """
+        Makes sure the key/value buffers can hold <batch_size> rows of <length> positions, reallocating them only if they
+        cannot. Reallocating discards the contents of the cache.
+        """
+        if self.k_cache is not None and self.k_cache.dtype == dtype and self.k_cache.device == device and \
+                self.k_cache.shape[1] >= batch_size and self.k_cache.shape[3] >= length:
+            return
+        if self.k_cache is not None:
+            batch_size = max(batch_size, self.k_cache.shape[1])
+            length = max(length, self.k_cache.shape[3])
+        self.release()
+        shape = (len(self.blocks), batch_size, self.heads, length, self.head_dim)
+        self.k_cache = torch.empty(shape, dtype=dtype, device=device)
+        self.v_cache = torch.empty(shape, dtype=dtype, device=device)
+
+    def release(self):
+        """
+        Frees the key/value buffers.
+        """
+        self.k_cache = None
+        self.v_cache = None
+
+    def compact(self, keep, kv_length):
+        """
+        Moves the rows of the key/value cache listed in the index tensor <keep> to the front, in order, so that the first
+        len(keep) rows are the ones still being decoded. Only the first <kv_length> positions are moved.
+        """
+        n = keep.shape[0]
+        for l in range(len(self.blocks)):
+            self.k_cache[l, :n, :, :kv_length] = self.k_cache[l, keep, :, :kv_length]
+            self.v_cache[l, :n, :, :kv_length] = self.v_cache[l, keep, :, :kv_length]
+
+    def _qkv(self, block, h):
+        b, s, _ = h.shape
+        q, k, v = block.attn.c_attn(block.ln_1(h)).split(self.model.model_dim, dim=2)
+        return [t.view(b, s, self.heads, self.head_dim).transpose(1, 2) for t in (q, k, v)]
+
+    def _finish_block(self, block, h, attn):
+        b, s, d = h.shape
+        h = h + block.attn.c_proj(attn.transpose(1, 2).reshape(b, s, d))
+        return h + block.mlp(block.ln_2(h))
+
+    def prefill(self, prefix, rows_per_prefix, max_length, start_row=0, reserve_rows=None):
+        """
+        Runs the (p,s,d) prefix embeddings through the model once each and writes their keys and values into the first
+        s positions of <rows_per_prefix> consecutive rows per prefix, starting at <start_row>. Room is reserved for
+        <reserve_rows> rows (by default just the ones written) of <max_length> positions.
+        """
+        p, s, _ = prefix.shape
+        keys, values = [], []
+        h = prefix
+        for block in self.blocks:
+            q, k, v = self._qkv(block, h)
+            keys.append(k)
+            values.append(v)
+            h = self._finish_block(block, h, attention(q, k, v, causal=True))
+        end_row = start_row + p * rows_per_prefix
+        self.reserve(end_row if reserve_rows is None else reserve_rows, max_length, keys[0].dtype, keys[0].device)
+        for l in range(len(self.blocks)):
+            # Broadcast each prefix over its rows instead of materializing copies of it.
+            k_rows = self.k_cache[l, start_row:end_row].view(p, rows_per_prefix, *self.k_cache.shape[2:])
+            v_rows = self.v_cache[l, start_row:end_row].view(p, rows_per_prefix, *self.v_cache.shape[2:])
+            k_rows[:, :, :, :s] = keys[l].unsqueeze(1)
+            v_rows[:, :, :, :s] = values[l].unsqueeze(1)
+
+    def embed(self, tokens, mel_positions):
+        """
+        Embeds mel codes at the given mel positions. <mel_positions> is an int or a tensor shaped like <tokens>.
+        """
+        return self.model.mel_embedding(tokens) + self.model.mel_pos_embedding.emb.weight[mel_positions]
+
+    def run_layers(self, h, slots, kv_length, start_layer=0, end_layer=None, mask=None):
+        """
+        Feeds the (b,q,d) hidden states of q consecutive tokens per row through layers [start_layer, end_layer) of the
+        model, writing their keys and values into the cache as it goes.
+
+        :param slots: Cache position the keys and values of the first token of every row are written to. An int if it is
+                      the same for every row, otherwise a (b,) tensor.
+        :param kv_length: Number of cache positions attended to.
+        :param mask: Optional (b,1,q,kv_length) boolean tensor marking the cache positions each token may attend to. By
+                     default every token attends to the positions up to its own, which needs no mask when q is 1 and
+                     every row has filled the first kv_length positions.
+        """
+        b, q, _ = h.shape
+        if mask is None and q > 1:
+            mask = self.causal_mask(slots, q, kv_length, h.device)
+        if isinstance(slots, int):
+            rows, positions = slice(0, b), slice(slots, slots + q)
+        else:
+            rows = torch.arange(b, device=h.device).unsqueeze(1)
+            positions = slots.unsqueeze(1) + torch.arange(q, device=h.device)
+        for l in range(start_layer, len(self.blocks) if end_layer is None else end_layer):
+            block = self.blocks[l]
+            query, k, v = self._qkv(block, h)
+            if isinstance(slots, int):
+                self.k_cache[l, rows, :, positions] = k
+                self.v_cache[l, rows, :, positions] = v
+            else:
+                self.k_cache[l][rows, :, positions] = k.transpose(1, 2)
+                self.v_cache[l][rows, :, positions] = v.transpose(1, 2)
+            attn = attention(query, self.k_cache[l, :b, :, :kv_length], self.v_cache[l, :b, :, :kv_length], mask)
+            h = self._finish_block(block, h, attn)
+        return h
+
+    @staticmethod
+    def causal_mask(slots, queries, kv_length, device):
+        """
+        Returns a mask for run_layers() that lets the <queries> tokens of every row, written from <slots> onward, attend to
+        the cache positions up to their own.
+        """
+        last = torch.as_tensor(slots, device=device).view(-1, 1, 1, 1) + torch.arange(queries, device=device).view(1, 1, -1, 1)
+        return torch.arange(kv_length, device=device).view(1, 1, 1, -1) <= last
+
+    def head(self, h):
+        """
+        Returns the final-norm latents and the mel code logits for hidden states produced by the last layer.
+        """
+        latent = self.model.final_norm(self.ln_f(h))
+        return latent, self.model.mel_head(latent)
+
+    def step(self, tokens, mel_positions, slots, kv_length, mask=None):
+        """
+        Feeds one mel token per row through the model.
+
+        :param tokens: (b,) mel codes, one for each of the first b rows of the cache.
+        :param mel_positions: Mel position embedding index of the tokens. An int if it is the same for every row,
+                              otherwise a (b,) tensor.
+        :param slots: Cache position the keys and values of the tokens are written to. An int or a (b,) tensor.
+        :param kv_length: Number of cache positions attended to.
+        :param mask: Optional (b,1,1,kv_length) boolean tensor marking the cache positions each row may attend to. Not
+                     needed when every row has filled the first kv_length positions.
+        :return: The final-norm latents (b,d) the tokens produce and the logits (b,vocab) for the next token.
+        """
+        h = self.run_layers(self.embed(tokens, mel_positions).unsqueeze(1), slots, kv_length, mask=mask)
+        return self.head(h[:, 0])
+
+    def process(self, scores, seen, do_sample=True, temperature=1.0, top_k=50, top_p=1.0, repetition_penalty=1.0,
+                typical_sampling=False, typical_mass=.9):
+        """
+        Applies the logits processors and, when sampling, warpers to <scores> in the same order generate() does. <seen>
+        marks the tokens each row has been fed so far and is used for the repetition penalty.
+        """
+        if repetition_penalty != 1.0:
+            scores = apply_repetition_penalty(scores, seen, repetition_penalty)
+        if typical_sampling:
+            scores = TypicalLogitsWarper(mass=typical_mass)(None, scores)
+        if do_sample:
+            scores = warp_scores(scores, temperature, top_k, top_p)
+        return scores
+
+    def sample(self, scores, seen, do_sample=True, *settings):
+        """
+        Picks the next token for every row from the logits in <scores>. Takes the same settings as process().
+        """
+        scores = self.process(scores, seen, do_sample, *settings)
+        if not do_sample:
+            return scores.argmax(dim=-1)
+        return torch.multinomial(F.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+
+    def distribution(self, scores, seen, do_sample=True, *settings):
+        """
+        Returns the probabilities sample() picks tokens with, as a float tensor. Greedy decoding puts all of the mass on
+        the highest scoring token.
+        """
+        scores = self.process(scores, seen, do_sample, *settings)
+        if not do_sample:
+            return F.one_hot(scores.argmax(dim=-1), scores.shape[-1]).float()
+        return F.softmax(scores.float(), dim=-1)
+
+    @torch.no_grad()
+    def generate(self, speech_conditioning_latent, text_inputs, num_return_sequences=1, max_generate_length=None,
+                 do_sample=True, temperature=1.0, top_k=50, top_p=1.0, repetition_penalty=1.0, length_penalty=1.0,
+                 typical_sampling=False, typical_mass=.9, return_latent=False, latent_dtype=None, evict_finished=True,
+                 draft_layers=None, speculative_tokens=4):
+        """
+        Samples mel codes for the given conditioning latents and text. Takes the same arguments and returns the same
+        thing as UnifiedVoice.inference_speech(). length_penalty is accepted for compatibility but, as with generate(),
+        only affects beam search, which is not supported.
+
+        With evict_finished, rows that have produced the stop token are dropped from the batch and the cache, so the
+        remaining rows are decoded without computing padding for the finished ones. Their codes are padded with the
+        stop token and their latents with the latent of the stop token. Sampling from fewer rows draws different random
+        numbers for the rows that remain, so results for a given seed differ from those without eviction.
+
+        If draft_layers is given, decoding is speculative: see generate_speculative().
+        """
+        if draft_layers is not None:
+            return self.generate_speculative(speech_conditioning_latent, text_inputs, draft_layers, speculative_tokens,
+                                             num_return_sequences, max_generate_length, do_sample, temperature, top_k,
+                                             top_p, repetition_penalty, typical_sampling, typical_mass, return_latent,
+                                             latent_dtype)
+        model = self.model
+        stop_token = model.stop_mel_token
+        max_new = model.max_mel_tokens - 1 if max_generate_length is None else max_generate_length
+
+        prefix = model.inference_prefix(speech_conditioning_latent, text_inputs)
+        prefix_length = prefix.shape[1]
+        b = prefix.shape[0] * num_return_sequences
+        self.prefill(prefix, num_return_sequences, prefix_length + max_new)
+
+        device = prefix.device
+        tokens = torch.full((b,), model.start_mel_token, dtype=torch.long, device=device)
+        codes = torch.full((b, max_new), stop_token, dtype=torch.long, device=device)
+        finished = torch.zeros((b,), dtype=torch.bool, device=device)
+        active = torch.arange(b, device=device)  # Maps rows of the cache to rows of the output.
+        lengths = torch.zeros((b,), dtype=torch.long, device=device)
+        # generate() is fed placeholder ids of 1 for the prefix followed by the start token, and penalizes those too.
+        seen = torch.zeros((b, model.number_mel_codes), dtype=torch.bool, device=device)
+        seen[:, 1] = True
+        seen[:, model.start_mel_token] = True
+        latents = None
+        steps = 0
+        for i in range(max_new):
+            latent, logits = self.step(tokens, i, prefix_length + i, prefix_length + i + 1)
+            if return_latent:
+                if latents is None:
+                    latents = torch.zeros((b, max_new, latent.shape[-1]), dtype=latent_dtype or latent.dtype, device=device)
+                latents[active, i] = latent.to(latents.dtype)
+            tokens = self.sample(logits, seen, do_sample, temperature, top_k, top_p, repetition_penalty,
+                                 typical_sampling, typical_mass)
+            tokens = tokens.masked_fill(finished, stop_token)
+            codes[active, i] = tokens
+            lengths[active] = i + 1
+            seen.scatter_(1, tokens.unsqueeze(1), True)
+            finished |= tokens == stop_token
+            steps = i + 1
+            if evict_finished:
+                if finished.any():
+                    keep = (~finished).nonzero().squeeze(1)
+                    if keep.shape[0] == 0:
+                        break
+                    self.compact(keep, prefix_length + i + 1)
+                    active, tokens, seen, finished = active[keep], tokens[keep], seen[keep], finished[keep]
+            elif finished.all():
+                break
+        codes = codes[:, :steps]
+        if return_latent:
+            # Rows that were evicted early repeat their last latent.
+            index = torch.minimum(torch.arange(steps, device=device).unsqueeze(0), lengths.unsqueeze(1) - 1)
+            return codes, latents.gather(1, index.unsqueeze(-1).expand(-1, -1, latents.shape[-1]))
+        return codes
+
+    @torch.no_grad()
+    def generate_speculative(self, speech_conditioning_latent, text_inputs, draft_layers, speculative_tokens=4,
+                             num_return_sequences=1, max_generate_length=None, do_sample=True, temperature=1.0, top_k=50,
+                             top_p=1.0, repetition_penalty=1.0, typical_sampling=False, typical_mass=.9,
+                             return_latent=False, latent_dtype=None):
+        """
+        Samples mel codes like generate(), using the first <draft_layers> layers of the model as a draft model.
+
+        Every round, the draft proposes <speculative_tokens> codes per row one at a time. The remaining layers then
+        verify all of them in a single pass. Proposals are accepted with the rejection sampling rule of speculative
+        sampling, so the codes follow the same distribution as those of generate(). The draft shares the first layers,
+        norms and mel_head with the full model. Its keys and values are therefore the full model's, and verification
+        carries on from the draft's hidden states rather than recomputing them. Each round produces between one and
+        speculative_tokens + 1 codes per row. Near the length limit, fewer codes are proposed, so that no row drafts
+        past it. Finished rows are always evicted.
+
+        The fraction of proposals accepted during the last call is kept in self.acceptance_rate.
+        """
+        assert 0 < draft_layers < len(self.blocks), 'The draft must be a strict subset of the layers.'
+        model = self.model
+        stop_token = model.stop_mel_token
+        max_new = model.max_mel_tokens - 1 if max_generate_length is None else max_generate_length
+        settings = (do_sample, temperature, top_k, top_p, repetition_penalty, typical_sampling, typical_mass)
+
+        prefix = model.inference_prefix(speech_conditioning_latent, text_inputs)
+        prefix_length = prefix.shape[1]
+        b = prefix.shape[0] * num_return_sequences
+        # Each round proposes at most as many codes as the furthest row has left, so that positions stay within
+        # max_new and the mel position embedding.
+        self.prefill(prefix, num_return_sequences, prefix_length + max_new + 1)
+
+        device = prefix.device
+        tokens = torch.full((b,), model.start_mel_token, dtype=torch.long, device=device)  # Not in the cache yet.
+        counts = torch.zeros((b,), dtype=torch.long, device=device)  # Codes generated so far, per row.
+        active = torch.arange(b, device=device)
+        lengths = torch.zeros((b,), dtype=torch.long, device=device)
+        codes = torch.full((b, max_new + 1), stop_token, dtype=torch.long, device=device)
+        seen = torch.zeros((b, model.number_mel_codes), dtype=torch.bool, device=device)
+        seen[:, 1] = True
+        seen[:, model.start_mel_token] = True
+        latents = None
+        proposed = accepted = 0
+        while active.shape[0] > 0:
+            n = active.shape[0]
+            row_counts = counts.tolist()
+            slots = prefix_length + counts
+            kv_length = prefix_length + max(row_counts) + 1
+            ragged = min(row_counts) != max(row_counts)
+            gamma = min(speculative_tokens, max_new - max(row_counts))
+
+            # Draft: propose gamma codes per row. The hidden state of the last proposal is needed for verification too.
+            hidden, proposals, draft_probs = [], [], []
+            draft_seen = seen.clone()
+            token = tokens
+            for j in range(gamma + 1):
+                mask = self.causal_mask(slots + j, 1, kv_length + j, device) if ragged else None
+                h = self.run_layers(self.embed(token, counts + j).unsqueeze(1), slots + j, kv_length + j,
+                                    end_layer=draft_layers, mask=mask)
+                hidden.append(h)
+                if j == gamma:
+                    break
+                probs = self.distribution(self.head(h[:, 0])[1], draft_seen, *settings)
+                token = torch.multinomial(probs, num_samples=1).squeeze(1)
+                proposals.append(token)
+                draft_probs.append(probs)
+                draft_seen.scatter_(1, token.unsqueeze(1), True)
+
+            # Verify: the rest of the model scores the current token and all proposals at once.
+            h = self.run_layers(torch.cat(hidden, dim=1), slots, kv_length + gamma, start_layer=draft_layers)
+            latent, logits = self.head(h)
+
+            rows = torch.arange(n, device=device)
+            emitted = torch.zeros((n,), dtype=torch.long, device=device)
+            open_rows = torch.ones((n,), dtype=torch.bool, device=device)  # Rows that have rejected nothing so far.
+            stopped = torch.zeros((n,), dtype=torch.bool, device=device)
+            for j in range(gamma + 1):
+                p = self.distribution(logits[:, j], seen, *settings)
+                if j < gamma:
+                    x, q = proposals[j], draft_probs[j]
+                    p_x = p.gather(1, x.unsqueeze(1)).squeeze(1)
+                    q_x = q.gather(1, x.unsqueeze(1)).squeeze(1)
+                    accept = torch.rand((n,), device=device) * q_x < p_x
+                    residual = (p - q).clamp(min=0)
+                    # The residual is empty only when p == q, in which case the proposal is always accepted.
+                    residual = torch.where(residual.sum(dim=-1, keepdim=True) > 0, residual, p)
+                    token = torch.where(accept, x, torch.multinomial(residual, num_samples=1).squeeze(1))
+                    accepted += (accept & open_rows).sum()
+                else:
+                    accept = torch.zeros((n,), dtype=torch.bool, device=device)
+                    token = torch.multinomial(p, num_samples=1).squeeze(1)
+                # Rows that are no longer open write past their end; those positions are overwritten or trimmed.
+                position = counts + emitted
+                codes[active, position] = token
+                if return_latent:
+                    if latents is None:
+                        latents = torch.zeros((b, codes.shape[1], latent.shape[-1]), device=device,
+                                              dtype=latent_dtype or latent.dtype)
+                    latents[active, position] = latent[:, j].to(latents.dtype)
+                seen[rows, token] |= open_rows
+                emitted += open_rows.long()
+                stopped |= open_rows & (token == stop_token)
+                open_rows &= accept & (token != stop_token)
+            proposed += gamma * n
+
+            counts += emitted
+            tokens = codes[active, counts - 1]
+            lengths[active] = counts.clamp(max=max_new)
+            keep = (~(stopped | (counts >= max_new))).nonzero().squeeze(1)
+            if keep.shape[0] < n:
+                self.compact(keep, kv_length + gamma)
+                active, tokens, counts, seen = active[keep], tokens[keep], counts[keep], seen[keep]
+
+        self.acceptance_rate = float(accepted) / max(proposed, 1)
+        steps = int(lengths.max())
+        positions = torch.arange(steps, device=device).unsqueeze(0)
+        codes = codes[:, :steps].masked_fill(positions >= lengths.unsqueeze(1), stop_token)
+        if return_latent:
+            index = torch.minimum(positions, lengths.unsqueeze(1) - 1)
+            return codes, latents.gather(1, index.unsqueeze(-1).expand(-1, -1, latents.shape[-1]))
+        return codes
+
+
+if __name__ == '__main__':
+    # Checks that ARDecoder reproduces the transformers generate() path on a tiny random model, then compares speeds.
+    from tortoise.models.autoregressive import UnifiedVoice
+
+    torch.manual_seed(0)
+    model = UnifiedVoice(layers=8, model_dim=256, heads=4, max_text_tokens=120, max_mel_tokens=200,
+                         max_conditioning_inputs=2, number_text_tokens=255, start_text_token=255,
+                         checkpointing=False).eval()
+    model.post_init_gpt2_config(kv_cache=False)
+    decoder = ARDecoder(model)
+    cond = torch.randn(1, 256)
+    text = torch.randint(1, 255, (1, 40))
+
+    with torch.no_grad():
+        hf_codes, hf_latents = model.inference_speech(cond, text, do_sample=False, max_generate_length=60,
+                                                      return_latent=True)
+        codes, latents = decoder.generate(cond, text, do_sample=False, max_generate_length=60, return_latent=True)
+    assert torch.equal(hf_codes, codes), 'Greedy codes differ.'
+    assert torch.allclose(hf_latents, latents, atol=1e-4), 'Latents differ.'
+
+    sampling = dict(num_return_sequences=4, max_generate_length=60, do_sample=True, temperature=.8, top_p=.8,
+                    repetition_penalty=2.0, typical_sampling=True)
+    with torch.no_grad():
+        torch.manual_seed(1)
+        hf_codes = model.inference_speech(cond, text, **sampling)
+        torch.manual_seed(1)
+        codes = decoder.generate(cond, text, evict_finished=False, **sampling)
+    assert torch.equal(hf_codes, codes), 'Sampled codes differ.'
+
+    # Make the random model stop at different points for different prompts, so that rows get evicted.
+    conds = torch.randn(4, 256)
+    texts = torch.randint(1, 255, (4, 40))
+    stop_bias = model.mel_head.bias.data[model.stop_mel_token].item()
+    model.mel_head.bias.data[model.stop_mel_token] = .9
+    with torch.no_grad():
+        hf_codes, hf_latents = model.inference_speech(conds, texts, do_sample=False, max_generate_length=60,
+                                                      repetition_penalty=2.0, return_latent=True)
+        codes, latents = decoder.generate(conds, texts, do_sample=False, max_generate_length=60,
+                                          repetition_penalty=2.0, return_latent=True)
+        spec_codes, spec_latents = decoder.generate(conds, texts, do_sample=False, max_generate_length=60,
+                                                    repetition_penalty=2.0, return_latent=True, draft_layers=2)
+    model.mel_head.bias.data[model.stop_mel_token] = stop_bias
+    assert torch.equal(hf_codes, codes), 'Codes differ with eviction.'
+    # Greedy speculative decoding is deterministic, so it has to reproduce greedy decoding exactly.
+    assert torch.equal(hf_codes, spec_codes), 'Speculative codes differ.'
+    lengths = (codes != model.stop_mel_token).sum(dim=1) + 1
+    for row, length in enumerate(lengths.tolist()):
+        assert torch.allclose(hf_latents[row, :length], latents[row, :length], atol=1e-4), 'Latents differ with eviction.'
+        assert torch.allclose(hf_latents[row, :length], spec_latents[row, :length], atol=1e-4), 'Speculative latents differ.'
+
+    # Rows that run to the length limit must not draft past it, even with more speculative tokens than the mel
+    # position embedding has spare rows.
+    short = UnifiedVoice(layers=4, model_dim=256, heads=4, max_text_tokens=120, max_mel_tokens=20,
+                         max_conditioning_inputs=2, number_text_tokens=255, start_text_token=255,
+                         checkpointing=False).eval()
+    short.mel_head.bias.data[short.stop_mel_token] = -1e4  # Never stop, so that every row reaches the limit.
+    with torch.no_grad():
+        expected = ARDecoder(short).generate(cond, text, do_sample=False)
+        spec_codes = ARDecoder(short).generate(cond, text, do_sample=False, draft_layers=2, speculative_tokens=8)
+    assert expected.shape[1] == short.max_mel_tokens - 1 and torch.equal(expected, spec_codes), \
+        'Speculative decoding to the length limit differs.'
+    print('ARDecoder matches generate().')
+
+    # Top-k is left off: the top 50 codes of a random model and of its first layers barely overlap, which makes the
+    # draft useless in a way that it would not be with trained weights.
+    model.post_init_gpt2_config(kv_cache=True)
+    timing = dict(num_return_sequences=16, max_generate_length=150, do_sample=True, temperature=.8, top_k=0)
+    for name, fn, extra in (('generate() with KV cache', model.inference_speech, {}),
+                            ('ARDecoder', decoder.generate, {}),
+                            ('ARDecoder, speculative with a 2 layer draft', decoder.generate, dict(draft_layers=2)),
+                            ('ARDecoder, speculative with a 4 layer draft', decoder.generate, dict(draft_layers=4))):
+        with torch.no_grad():
+            fn(cond, text, **timing, **extra)  # Warm up.
+            start = time()
+            codes = fn(cond, text, **timing, **extra)
+            elapsed = time() - start
+        acceptance = f' ({decoder.acceptance_rate:.0%} of proposals accepted)' if extra else ''
+        print(f'{name}: {codes.numel() / elapsed:.0f} tokens/s{acceptance}')
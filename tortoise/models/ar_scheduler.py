@@ -0,0 +1,192 @@
+from collections import deque
+from itertools import count
+
+import torch
+
+from tortoise.models.ar_decoder import ARDecoder
+
+
+class ARRequest:
+    def __init__(self, request_id, speech_conditioning_latent, text_inputs, num_samples, max_generate_length):
+        self.request_id = request_id
+        self.speech_conditioning_latent = speech_conditioning_latent
+        self.text_inputs = text_inputs
+        self.num_samples = num_samples
+        self.max_generate_length = max_generate_length
+        self.codes = [None] * num_samples
+        self.remaining = num_samples
+
+
+class ARScheduler:
+    """
+    Continuously batches autoregressive sampling for many independent requests, each with its own conditioning latent,
+    text and number of samples.
+
+    One decode batch is kept running. Requests submitted with submit() are admitted at token boundaries whenever there
+    are enough free rows for all of their samples: their prefix is computed once and written into the rows of the shared
+    key/value cache, after which those rows decode alongside the others at their own positions. Rows are retired as soon
+    as they produce the stop token or reach their request's length limit, and a request is returned by step() once all of
+    its rows have been retired.
+
+    Sampling settings are shared by all requests. Requests are admitted in the order they were submitted. submit() may be
+    called from other threads while step() runs.
+    """
+    def __init__(self, model, max_batch_size=64, do_sample=True, temperature=.8, top_k=50, top_p=.8,
+                 repetition_penalty=2.0, typical_sampling=False, typical_mass=.9):
+        self.model = model
+        # A private decoder, so that its cache is not the one model.native_decoder reserves and releases for tts().
+        self.decoder = ARDecoder(model)
+        self.max_batch_size = max_batch_size
+        self.sampling = (do_sample, temperature, top_k, top_p, repetition_penalty, typical_sampling, typical_mass)
+        # Longest possible prefix (conditioning latent + text with start and stop tokens) plus the longest sequence.
+        self.max_length = 1 + model.max_text_tokens + 2 + model.max_mel_tokens
+        self.pending = deque()
+        self.ids = count()
+
+        # Per-row state of the running batch. The first self.rows rows of every tensor are in use.
+        self.rows = 0
+        self.row_requests = []  # (request, sample index) of each row.
+        self.row_slots = []  # Cache position the next token of each row is written to.
+        self.row_limits = []  # Number of tokens each row may generate.
+        self.tokens = None
+        self.mel_positions = None
+        self.seen = None
+        self.codes = None
+
+    @property
+    def idle(self):
+        return self.rows == 0 and not self.pending
+
+    def submit(self, speech_conditioning_latent, text_inputs, num_samples=1, max_generate_length=None):
+        """
+        Queues a request for <num_samples> samples of mel codes for a single (1,d) conditioning latent and (1,s) text.
+        Returns the id that step() reports the request's codes under.
+        """
+        assert speech_conditioning_latent.shape[0] == 1 and text_inputs.shape[0] == 1, 'Submit one prompt per request.'
+        if num_samples > self.max_batch_size:
+            raise ValueError(f'A request for {num_samples} samples can never fit in a batch of {self.max_batch_size}.')
+        if max_generate_length is None:
+            max_generate_length = self.model.max_mel_tokens - 1
+        request = ARRequest(next(self.ids), speech_conditioning_latent, text_inputs, num_samples, max_generate_length)
+        self.pending.append(request)
+        return request.request_id
+
+    def _allocate(self, device):
+        self.tokens = torch.empty((self.max_batch_size,), dtype=torch.long, device=device)
+        self.mel_positions = torch.empty((self.max_batch_size,), dtype=torch.long, device=device)
+        self.seen = torch.empty((self.max_batch_size, self.model.number_mel_codes), dtype=torch.bool, device=device)
+        self.codes = torch.empty((self.max_batch_size, self.model.max_mel_tokens), dtype=torch.long, device=device)
+
+    def _admit(self):
+        while self.pending and self.rows + self.pending[0].num_samples <= self.max_batch_size:
+            request = self.pending.popleft()
+            prefix = self.model.inference_prefix(request.speech_conditioning_latent, request.text_inputs)
+            if self.tokens is None:
+                self._allocate(prefix.device)
+            start, end = self.rows, self.rows + request.num_samples
+            self.decoder.prefill(prefix, request.num_samples, self.max_length, start_row=start,
+                                 reserve_rows=self.max_batch_size)
+            self.tokens[start:end] = self.model.start_mel_token
+            self.mel_positions[start:end] = 0
+            # Matches what generate() penalizes; see ARDecoder.generate().
+            self.seen[start:end] = False
+            self.seen[start:end, 1] = True
+            self.seen[start:end, self.model.start_mel_token] = True
+            self.rows = end
+            self.row_requests.extend((request, i) for i in range(request.num_samples))
+            self.row_slots.extend([prefix.shape[1]] * request.num_samples)
+            self.row_limits.extend([request.max_generate_length] * request.num_samples)
+
+    @torch.no_grad()
+    def step(self):
+        """
+        Admits as many pending requests as fit, then generates one token for every running row. Returns a list of
+        (request id, codes) for the requests that finished during this step, where codes is a (num_samples,s) tensor
+        padded with the stop token like the output of UnifiedVoice.inference_speech().
+        """
+        self._admit()
+        if self.rows == 0:
+            return []
+        n = self.rows
+        stop_token = self.model.stop_mel_token
+        kv_length = max(self.row_slots) + 1
+        slots = torch.tensor(self.row_slots, device=self.tokens.device)
+        mask = None
+        if min(self.row_slots) != kv_length - 1:
+            # Rows sit at different positions; keep each of them from attending past its own.
+            mask = torch.arange(kv_length, device=slots.device).unsqueeze(0) <= slots.unsqueeze(1)
+            mask = mask.view(n, 1, 1, kv_length)
+        positions = self.mel_positions[:n]
+        _, logits = self.decoder.step(self.tokens[:n], positions, slots, kv_length, mask)
+        tokens = self.decoder.sample(logits, self.seen[:n], *self.sampling)
+        self.tokens[:n] = tokens
+        self.codes[torch.arange(n, device=tokens.device), positions] = tokens
+        self.seen[:n].scatter_(1, tokens.unsqueeze(1), True)
+        positions += 1
+        self.row_slots = [slot + 1 for slot in self.row_slots]
+
+        limits = torch.tensor(self.row_limits, device=tokens.device)
+        finished = ((tokens == stop_token) | (positions >= limits)).nonzero().squeeze(1).tolist()
+        if not finished:
+            return []
+
+        completed = []
+        done = set(finished)
+        for row in finished:
+            request, sample = self.row_requests[row]
+            request.codes[sample] = self.codes[row, :self.mel_positions[row]].clone()
+            request.remaining -= 1
+            if request.remaining == 0:
+                length = max(c.shape[0] for c in request.codes)
+                codes = torch.full((request.num_samples, length), stop_token, dtype=torch.long, device=tokens.device)
+                for i, c in enumerate(request.codes):
+                    codes[i, :c.shape[0]] = c
+                completed.append((request.request_id, codes))
+
+        keep = [row for row in range(n) if row not in done]
+        if keep:
+            keep_index = torch.tensor(keep, device=tokens.device)
+            self.decoder.compact(keep_index, kv_length)
+            for state in (self.tokens, self.mel_positions, self.seen, self.codes):
+                state[:len(keep)] = state[keep_index]
+        self.rows = len(keep)
+        self.row_requests = [self.row_requests[row] for row in keep]
+        self.row_slots = [self.row_slots[row] for row in keep]
+        self.row_limits = [self.row_limits[row] for row in keep]
+        return completed
+
+    def run(self):
+        """
+        Steps until every submitted request has finished, yielding (request id, codes) as they do.
+        """
+        while not self.idle:
+            yield from self.step()
+
+
+if __name__ == '__main__':
+    # Checks that requests batched together decode the same as when decoded on their own, on a tiny random model.
+    from tortoise.models.autoregressive import UnifiedVoice
+
+    torch.manual_seed(0)
+    model = UnifiedVoice(layers=4, model_dim=256, heads=4, max_text_tokens=120, max_mel_tokens=200,
+                         max_conditioning_inputs=2, number_text_tokens=255, start_text_token=255,
+                         checkpointing=False).eval()
+    model.post_init_gpt2_config(native_decoder=True)
+    model.mel_head.bias.data[model.stop_mel_token] = .9  # Make the random model stop at varying points.
+    prompts = [(torch.randn(1, 256), torch.randint(1, 255, (1, length))) for length in (40, 12, 75, 30)]
+
+    scheduler = ARScheduler(model, max_batch_size=6, do_sample=False)
+    with torch.no_grad():
+        expected = [model.inference_speech(cond, text, max_generate_length=60, do_sample=False, top_p=.8,
+                                           temperature=.8, repetition_penalty=2.0) for cond, text in prompts]
+        results = {}
+        # Submit the later requests while the first ones are already decoding.
+        scheduler.submit(*prompts[0], num_samples=2, max_generate_length=60)
+        for _ in range(3):
+            results.update(scheduler.step())
+        for cond, text in prompts[1:]:
+            scheduler.submit(cond, text, num_samples=2, max_generate_length=60)
+        results.update(scheduler.run())
+    for request_id, codes in enumerate(expected):
+        assert torch.equal(results[request_id], codes.repeat(2, 1)), f'Request {request_id} differs.'
+    print('ARScheduler matches decoding requests one at a time.')
@@ -19,8 +19,24 @@ def zero_module(module):
 
 
 class GroupNorm32(nn.GroupNorm):
-    def forward(self, x):
-        return super().forward(x.float()).type(x.dtype)
+    def forward(self, x, mask=None):
+        """
+        :param x: an [N x C x T] tensor.
+        :param mask: optional [N x T] boolean tensor of the positions that hold data. When given, the group statistics are
+                     computed over those positions only, so that padding does not change the result.
+        """
+        if mask is None:
+            return super().forward(x.float()).type(x.dtype)
+        b, c, t = x.shape
+        h = x.float().reshape(b, self.num_groups, -1, t)
+        m = mask.reshape(b, 1, 1, t).float()
+        count = m.sum(dim=(2, 3), keepdim=True) * h.shape[2]
+        mean = (h * m).sum(dim=(2, 3), keepdim=True) / count
+        var = ((h - mean) ** 2 * m).sum(dim=(2, 3), keepdim=True) / count
+        h = ((h - mean) / torch.sqrt(var + self.eps)).reshape(b, c, t)
+        if self.affine:
+            h = h * self.weight.view(1, c, 1) + self.bias.view(1, c, 1)
+        return h.type(x.dtype)
 
 
 def normalization(channels):
@@ -55,6 +71,7 @@ class QKVAttentionLegacy(nn.Module):
         Apply QKV attention.
 
         :param qkv: an [N x (H * 3 * C) x T] tensor of Qs, Ks, and Vs.
+        :param mask: optional [N x T] boolean tensor of the positions that may be attended to.
         :return: an [N x (H * C) x T] tensor after attention.
         """
         bs, width, length = qkv.shape
@@ -67,11 +84,13 @@ class QKVAttentionLegacy(nn.Module):
         )  # More stable with f16 than dividing afterwards
         if rel_pos is not None:
             weight = rel_pos(weight.reshape(bs, self.n_heads, weight.shape[-2], weight.shape[-1])).reshape(bs * self.n_heads, weight.shape[-2], weight.shape[-1])
-        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
+        dtype = weight.dtype
+        weight = weight.float()
         if mask is not None:
-            # The proper way to do this is to mask before the softmax using -inf, but that doesn't work properly on CPUs.
-            mask = mask.repeat(self.n_heads, 1).unsqueeze(1)
-            weight = weight * mask
+            # Mask with the most negative finite value rather than -inf, which doesn't work properly on CPUs.
+            mask = mask.bool().repeat_interleave(self.n_heads, dim=0).unsqueeze(1)
+            weight = weight.masked_fill(~mask, torch.finfo(weight.dtype).min)
+        weight = torch.softmax(weight, dim=-1).type(dtype)
         a = torch.einsum("bts,bcs->bct", weight, v)
 
         return a.reshape(bs, -1, length)
@@ -117,7 +136,7 @@ class AttentionBlock(nn.Module):
     def forward(self, x, mask=None):
         b, c, *spatial = x.shape
         x = x.reshape(b, c, -1)
-        qkv = self.qkv(self.norm(x))
+        qkv = self.qkv(self.norm(x, mask))
         h = self.attention(qkv, mask, self.relative_pos_embeddings)
         h = self.proj_out(h)
         return (x + h).reshape(b, c, *spatial)
@@ -6,6 +6,7 @@ import torch.nn.functional as F
 from transformers import GPT2Config, GPT2PreTrainedModel, LogitsProcessorList
 from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
 from transformers.utils.model_parallel_utils import get_device_map, assert_device_map
+from tortoise.models.ar_decoder import ARDecoder
 from tortoise.models.arch_util import AttentionBlock
 from tortoise.utils.typical_sampling import TypicalLogitsWarper
 
@@ -45,6 +46,9 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
         self.model_parallel = False
         self.device_map = None
         self.cached_mel_emb = None
+        self.captured_latents = None
+        self.captured_latent_dtype = None
+
     def parallelize(self, device_map=None):
         self.device_map = (
             get_device_map(len(self.transformer.h), range(max(1, torch.cuda.device_count())))
@@ -74,6 +78,36 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
     def store_mel_emb(self, mel_emb):
         self.cached_mel_emb = mel_emb
 
+    def compute_prefix_kv(self, num_rows):
+        """
+        Runs the stored conditioning+text prefix through the transformer once and returns its key/value cache broadcast to
+        <num_rows> rows, so that generate() only has to compute the sampled mel tokens for every row. Rows are ordered
+        the same way generate() expands its inputs for num_return_sequences.
+        """
+        past = self.transformer(inputs_embeds=self.cached_mel_emb, use_cache=True, return_dict=True).past_key_values
+        prefix_rows = self.cached_mel_emb.shape[0]
+        if prefix_rows == 1:
+            # Broadcast rather than copy; the cache is only ever concatenated onto, never written in place.
+            return tuple(tuple(t.expand(num_rows, -1, -1, -1) for t in layer) for layer in past)
+        return tuple(tuple(t.repeat_interleave(num_rows // prefix_rows, 0) for t in layer) for layer in past)
+
+    def start_latent_capture(self, dtype=None):
+        """
+        Starts recording the final-norm hidden state of the last position of every forward pass, which is the latent that
+        the generated token was sampled from. Latents are stored in <dtype> if specified.
+        """
+        self.captured_latents = []
+        self.captured_latent_dtype = dtype
+
+    def stop_latent_capture(self):
+        """
+        Stops recording latents and returns those recorded since start_latent_capture() as a (b,s,d) tensor, where s is
+        the number of generated tokens.
+        """
+        latents = torch.cat(self.captured_latents, dim=1) if self.captured_latents else None
+        self.captured_latents = None
+        return latents
+
     def prepare_inputs_for_generation(self, input_ids, past_key_values=None, **kwargs):
         token_type_ids = kwargs.get("token_type_ids", None)  # usually None
         if not self.kv_cache:
@@ -143,9 +177,13 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
             emb = torch.cat([mel_emb, text_emb], dim=1)
         else:
             emb = self.embeddings(input_ids)
-            emb = emb + self.text_pos_embedding.get_fixed_embedding(
-                attention_mask.shape[1] - mel_len, attention_mask.device
-            )
+            if past_key_values is not None and past_key_values[0][0].shape[-2] == mel_len:
+                # The start token, fed on its own after a shared prefix from compute_prefix_kv(). Position it where it
+                # would have been had it been fed together with the prefix.
+                pos = 0
+            else:
+                pos = attention_mask.shape[1] - mel_len
+            emb = emb + self.text_pos_embedding.get_fixed_embedding(pos, attention_mask.device)
         transformer_outputs = self.transformer(
             inputs_embeds=emb,
             past_key_values=past_key_values,
@@ -170,6 +208,11 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
                 torch.cuda.set_device(self.transformer.first_device)
             hidden_states = hidden_states.to(self.lm_head.weight.device)
 
+        if self.captured_latents is not None:
+            latent = self.lm_head[0](hidden_states[:, -1:])
+            if self.captured_latent_dtype is not None:
+                latent = latent.to(self.captured_latent_dtype)
+            self.captured_latents.append(latent)
         lm_logits = self.lm_head(hidden_states)
 
         if not return_dict:
@@ -354,7 +397,7 @@ class UnifiedVoice(nn.Module):
             embeddings.append(self.mel_embedding)
         for module in embeddings:
             module.weight.data.normal_(mean=0.0, std=.02)
-    def post_init_gpt2_config(self, use_deepspeed=False, kv_cache=False, half=False):
+    def post_init_gpt2_config(self, use_deepspeed=False, kv_cache=False, half=False, native_decoder=False):
         seq_length = self.max_mel_tokens + self.max_text_tokens + 2
         gpt_config = GPT2Config(
             vocab_size=self.max_mel_tokens,
@@ -394,6 +437,7 @@ class UnifiedVoice(nn.Module):
 
         # self.inference_model = PrunedGPT2InferenceModel(gpt_config, self.gpt, self.mel_pos_embedding, self.mel_embedding, self.final_norm, self.mel_head)
         self.gpt.wte = self.mel_embedding
+        self.native_decoder = ARDecoder(self) if native_decoder else None
     def build_aligned_inputs_and_targets(self, input, start_token, stop_token):
         inp = F.pad(input, (1,0), value=start_token)
         tar = F.pad(input, (0,1), value=stop_token)
@@ -510,18 +554,43 @@ class UnifiedVoice(nn.Module):
         loss_mel = F.cross_entropy(mel_logits, mel_targets.long())
         return loss_text.mean(), loss_mel.mean(), mel_logits
 
-    def inference_speech(self, speech_conditioning_latent, text_inputs, input_tokens=None, num_return_sequences=1,
-                         max_generate_length=None, typical_sampling=False, typical_mass=.9, **hf_generate_kwargs):        
-
+    def inference_prefix(self, speech_conditioning_latent, text_inputs):
+        """
+        Returns the embedded conditioning latent and text that mel codes are generated after, as a (b,s,d) tensor.
+        """
         text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
         text_inputs, _ = self.build_aligned_inputs_and_targets(text_inputs, self.start_text_token, self.stop_text_token)
         text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
-
         conds = speech_conditioning_latent.unsqueeze(1)
-        emb = torch.cat([conds, text_emb], dim=1)
+        return torch.cat([conds, text_emb], dim=1)
+
+    def inference_speech(self, speech_conditioning_latent, text_inputs, input_tokens=None, num_return_sequences=1,
+                         max_generate_length=None, typical_sampling=False, typical_mass=.9, return_latent=False,
+                         latent_dtype=None, **hf_generate_kwargs):
+        """
+        Samples mel codes for the given conditioning latent and text.
+
+        If return_latent is specified, the final-norm hidden states that each code was sampled from are recorded while
+        generating and returned alongside the codes as a (b,s,d) tensor, optionally stored as <latent_dtype>. These are
+        what forward(..., return_latent=True) computes for the generated codes, with two caveats: with the HF KV cache
+        enabled, sampling places each mel token one position further along than teacher forcing does, and sequences that
+        have finished keep being fed the stop token.
+
+        If the model was set up with native_decoder=True, sampling is done by ARDecoder rather than generate(), unless
+        input_tokens are given. Only the sampling arguments ARDecoder.generate() accepts may be passed in that case.
+        """
+        if self.native_decoder is not None and input_tokens is None:
+            return self.native_decoder.generate(speech_conditioning_latent, text_inputs,
+                                                num_return_sequences=num_return_sequences,
+                                                max_generate_length=max_generate_length,
+                                                typical_sampling=typical_sampling, typical_mass=typical_mass,
+                                                return_latent=return_latent, latent_dtype=latent_dtype,
+                                                **hf_generate_kwargs)
+
+        emb = self.inference_prefix(speech_conditioning_latent, text_inputs)
         self.inference_model.store_mel_emb(emb)
 
-        fake_inputs = torch.full((emb.shape[0], conds.shape[1] + emb.shape[1],), fill_value=1, dtype=torch.long,
+        fake_inputs = torch.full((emb.shape[0], emb.shape[1] + 1,), fill_value=1, dtype=torch.long,
                                  device=text_inputs.device)
         fake_inputs[:, -1] = self.start_mel_token
         trunc_index = fake_inputs.shape[1]
@@ -533,11 +602,25 @@ class UnifiedVoice(nn.Module):
             input_tokens = input_tokens.repeat(num_return_sequences // input_tokens.shape[0], 1)
             inputs = torch.cat([fake_inputs, input_tokens], dim=1)
 
+        if input_tokens is None and self.inference_model.kv_cache and not hasattr(self, 'ds_engine'):
+            # The prefix is identical for every returned sequence, so compute its key/value cache once and share it
+            # across the rows instead of having generate() recompute it for each of them.
+            hf_generate_kwargs = dict(hf_generate_kwargs,
+                                      past_key_values=self.inference_model.compute_prefix_kv(emb.shape[0] * num_return_sequences))
+
         logits_processor = LogitsProcessorList([TypicalLogitsWarper(mass=typical_mass)]) if typical_sampling else LogitsProcessorList()
         max_length = trunc_index + self.max_mel_tokens - 1  if max_generate_length is None else trunc_index + max_generate_length
-        gen = self.inference_model.generate(inputs, bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token, eos_token_id=self.stop_mel_token,
-                                            max_length=max_length, logits_processor=logits_processor,
-                                            num_return_sequences=num_return_sequences, **hf_generate_kwargs)
+        if return_latent:
+            assert input_tokens is None, "Latents can only be recorded when generating from scratch."
+            self.inference_model.start_latent_capture(latent_dtype)
+        try:
+            gen = self.inference_model.generate(inputs, bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token, eos_token_id=self.stop_mel_token,
+                                                max_length=max_length, logits_processor=logits_processor,
+                                                num_return_sequences=num_return_sequences, **hf_generate_kwargs)
+        finally:
+            latents = self.inference_model.stop_latent_capture() if return_latent else None
+        if return_latent:
+            return gen[:, trunc_index:], latents
         return gen[:, trunc_index:]
 
 
@@ -1,13 +1,14 @@
 import math
 import random
 from abc import abstractmethod
+from contextlib import nullcontext
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch import autocast
 
-from tortoise.models.arch_util import normalization, AttentionBlock
+from tortoise.models.arch_util import normalization, AttentionBlock, GroupNorm32
 
 
 def is_latent(t):
@@ -39,19 +40,35 @@ def timestep_embedding(timesteps, dim, max_period=10000):
     return embedding
 
 
+def masked_sequential(layers, x, mask):
+    """
+    Applies <layers> to an [N x C x T] tensor of which only the positions in the [N x T] boolean <mask> hold data. Group
+    norms only gather statistics over those positions and convolutions only see zeros past them, so each batch element
+    comes out the same as if it had been run on its own without padding.
+    """
+    for layer in layers:
+        if isinstance(layer, GroupNorm32):
+            x = layer(x, mask)
+        elif isinstance(layer, nn.Conv1d):
+            x = layer(x * mask.unsqueeze(1))
+        else:
+            x = layer(x)
+    return x
+
+
 class TimestepBlock(nn.Module):
     @abstractmethod
-    def forward(self, x, emb):
+    def forward(self, x, emb, mask=None):
         """
-        Apply the module to `x` given `emb` timestep embeddings.
+        Apply the module to `x` given `emb` timestep embeddings, with `mask` marking the positions of `x` that hold data.
         """
 
 
 class TimestepEmbedSequential(nn.Sequential, TimestepBlock):
-    def forward(self, x, emb):
+    def forward(self, x, emb, mask=None):
         for layer in self:
             if isinstance(layer, TimestepBlock):
-                x = layer(x, emb)
+                x = layer(x, emb, mask)
             else:
                 x = layer(x)
         return x
@@ -104,19 +121,24 @@ class ResBlock(TimestepBlock):
         else:
             self.skip_connection = nn.Conv1d(channels, self.out_channels, eff_kernel, padding=eff_padding)
 
-    def forward(self, x, emb):
-        h = self.in_layers(x)
+    def forward(self, x, emb, mask=None):
+        if mask is None:
+            h = self.in_layers(x)
+        else:
+            h = masked_sequential(self.in_layers, x, mask)
         emb_out = self.emb_layers(emb).type(h.dtype)
         while len(emb_out.shape) < len(h.shape):
             emb_out = emb_out[..., None]
         if self.use_scale_shift_norm:
             out_norm, out_rest = self.out_layers[0], self.out_layers[1:]
             scale, shift = torch.chunk(emb_out, 2, dim=1)
-            h = out_norm(h) * (1 + scale) + shift
-            h = out_rest(h)
+            h = out_norm(h, mask) * (1 + scale) + shift
+            h = out_rest(h) if mask is None else masked_sequential(out_rest, h, mask)
         else:
             h = h + emb_out
-            h = self.out_layers(h)
+            h = self.out_layers(h) if mask is None else masked_sequential(self.out_layers, h, mask)
+        if mask is not None and not isinstance(self.skip_connection, nn.Identity):
+            x = x * mask.unsqueeze(1)
         return self.skip_connection(x) + h
 
 
@@ -126,9 +148,137 @@ class DiffusionLayer(TimestepBlock):
         self.resblk = ResBlock(model_channels, model_channels, dropout, model_channels, dims=1, use_scale_shift_norm=True)
         self.attn = AttentionBlock(model_channels, num_heads, relative_pos_embeddings=True)
 
-    def forward(self, x, time_emb):
-        y = self.resblk(x, time_emb)
-        return self.attn(y)
+    def forward(self, x, time_emb, mask=None):
+        y = self.resblk(x, time_emb, mask)
+        return self.attn(y, mask)
+
+
+class LayerCache:
+    """
+    Reuses the work of the middle DiffusionTts.layers across sampling steps, in the manner of DeepCache (Ma et al., 2023).
+    Adjacent diffusion steps change the activations of these layers very little, so on a "full" step the residual that the
+    middle layers add to their input is cached, and on the following steps only the first <shallow_layers> and the last
+    <deep_layers> layers are computed while the cached residual stands in for the rest. A residual is recomputed once it
+    is <refresh_interval> sampling steps old.
+
+    Pass an instance to DiffusionTts.forward() as layer_cache, using a new one for every sampling run. The sampling loops
+    call the model once per step, so every call counts as a step; the timesteps are not read back from the device. Calls
+    in different roles (conditioned, conditioning-free, or both as one doubled batch) are cached apart, and clear() must
+    be called whenever the rows of the batch change.
+    """
+    def __init__(self, refresh_interval=3, shallow_layers=1, deep_layers=1):
+        assert shallow_layers >= 1
+        self.refresh_interval = refresh_interval
+        self.shallow_layers = shallow_layers
+        self.deep_layers = deep_layers
+        self.entries = {}  # Role -> (cached residual, sampling step it was computed at).
+        self.children = {}  # Key -> LayerCache, for callers that split inputs up, like WindowedDiffusion.
+        self.step = -1  # Number of sampling steps seen, one per call.
+        self.full_calls = 0
+        self.cached_calls = 0
+
+    def child(self, key):
+        """
+        Returns a LayerCache with the same settings for the part of the inputs identified by <key>, e.g. a window, as
+        such parts must not share cached activations. It is cleared along with this one.
+        """
+        if key not in self.children:
+            self.children[key] = LayerCache(self.refresh_interval, self.shallow_layers, self.deep_layers)
+        return self.children[key]
+
+    def clear(self):
+        """
+        Drops every cached residual, so that the next call of each role is a full one.
+        """
+        self.entries.clear()
+        for child in self.children.values():
+            child.clear()
+
+    def apply(self, layers, x, time_emb, mask=None, role='conditioned'):
+        """
+        Runs <layers>, which are DiffusionTts.layers without the first layer, on <x> for the next sampling step.
+        """
+        self.step += 1
+        head = layers[:self.shallow_layers - 1]
+        middle = layers[self.shallow_layers - 1:len(layers) - self.deep_layers]
+        tail = layers[len(layers) - self.deep_layers:]
+        for lyr in head:
+            x = lyr(x, time_emb, mask)
+        entry = self.entries.get(role)
+        if entry is None or entry[0].shape != x.shape or self.step - entry[1] >= self.refresh_interval:
+            h = x
+            for lyr in middle:
+                h = lyr(h, time_emb, mask)
+            self.entries[role] = (h - x, self.step)
+            self.full_calls += 1
+            x = h
+        else:
+            x = x + entry[0]
+            self.cached_calls += 1
+        for lyr in tail:
+            x = lyr(x, time_emb, mask)
+        return x
+
+
+class WindowedDiffusion(nn.Module):
+    """
+    Wraps a DiffusionTts so that every call runs it over overlapping windows of the input in turn, rather than over the
+    whole sequence at once, and crossfades the outputs of the windows where they overlap. Self-attention then only spans
+    a window, so the memory a step takes is bounded by the window size and its time grows linearly with the length.
+    Since the windows are blended on every step they all denoise the same shared noisy input and stay consistent with
+    each other, in the manner of MultiDiffusion (Bar-Tal et al., 2023).
+
+    Use it in place of the model for a single sampling run. Inputs must be given as precomputed_aligned_embeddings.
+
+    :param window: length of the windows, in output frames.
+    :param overlap: number of frames that neighbouring windows overlap by and are crossfaded over.
+    """
+    def __init__(self, model, window=512, overlap=64):
+        super().__init__()
+        assert 0 < overlap and 2 * overlap <= window
+        self.model = model
+        self.window = window
+        self.overlap = overlap
+
+    def spans(self, length):
+        """
+        Returns the (start, end) of each window over a sequence of <length> frames.
+        """
+        if length <= self.window:
+            return [(0, length)]
+        starts = list(range(0, length - self.window, self.window - self.overlap)) + [length - self.window]
+        return [(start, start + self.window) for start in starts]
+
+    def forward(self, x, timesteps, precomputed_aligned_embeddings=None, mask=None, layer_cache=None, **kwargs):
+        assert precomputed_aligned_embeddings is not None
+        spans = self.spans(x.shape[-1])
+        if len(spans) == 1:
+            return self.model(x, timesteps, precomputed_aligned_embeddings=precomputed_aligned_embeddings, mask=mask,
+                              layer_cache=layer_cache, **kwargs)
+        ramp = torch.arange(1, self.overlap + 1, device=x.device, dtype=torch.float) / (self.overlap + 1)
+        out = None
+        total_weight = torch.zeros(x.shape[-1], device=x.device)
+        for start, end in spans:
+            window_mask = None
+            if mask is not None:
+                window_mask = mask[:, start:end]
+                # Windows that only hold padding for some batch element are computed unmasked, as a fully masked
+                # normalization is undefined. Their output is padding too.
+                window_mask = window_mask | ~window_mask.any(dim=1, keepdim=True)
+            window_cache = None if layer_cache is None else layer_cache.child(start)
+            window_out = self.model(x[..., start:end], timesteps,
+                                    precomputed_aligned_embeddings=precomputed_aligned_embeddings[..., start:end],
+                                    mask=window_mask, layer_cache=window_cache, **kwargs)
+            weight = torch.ones(end - start, device=x.device)
+            if start > 0:
+                weight[:self.overlap] = ramp
+            if end < x.shape[-1]:
+                weight[-self.overlap:] = ramp.flip(0)
+            if out is None:
+                out = torch.zeros(*window_out.shape[:-1], x.shape[-1], device=x.device, dtype=window_out.dtype)
+            out[..., start:end] += window_out * weight
+            total_weight[start:end] += weight
+        return out / total_weight
 
 
 class DiffusionTts(nn.Module):
@@ -259,7 +409,30 @@ class DiffusionTts(nn.Module):
             mel_pred = mel_pred * unconditioned_batches.logical_not()
             return expanded_code_emb, mel_pred
 
-    def forward(self, x, timesteps, aligned_conditioning=None, conditioning_latent=None, precomputed_aligned_embeddings=None, conditioning_free=False, return_code_pred=False):
+    def precompute_time_embeddings(self, timesteps):
+        """
+        Computes the time embeddings for an ascending 1-D Tensor of all the timesteps a sampling run will use. Passing the
+        result to forward() as time_embedding_table has it look the embeddings up instead of recomputing them each step.
+        """
+        if timesteps.shape[0] > 1 and not (timesteps[1:] > timesteps[:-1]).all():
+            raise ValueError('The timesteps of a time embedding table must be strictly ascending.')
+        return timesteps, self.time_embed(timestep_embedding(timesteps, self.model_channels))
+
+    def time_embedding(self, timesteps, time_embedding_table=None):
+        if time_embedding_table is not None:
+            table_timesteps, table = time_embedding_table
+            timesteps = timesteps.to(table_timesteps.dtype).contiguous()
+            index = torch.searchsorted(table_timesteps, timesteps).clamp(max=table_timesteps.shape[0] - 1)
+            found = (table_timesteps[index] == timesteps).all()
+            if timesteps.device.type != 'cpu':
+                # Checked on the device, so that the lookup does not wait for the host.
+                torch._assert_async(found)
+            elif not found:
+                raise ValueError('The time embedding table was precomputed for other timesteps than the ones given.')
+            return table[index]
+        return self.time_embed(timestep_embedding(timesteps, self.model_channels))
+
+    def forward(self, x, timesteps, aligned_conditioning=None, conditioning_latent=None, precomputed_aligned_embeddings=None, conditioning_free=False, return_code_pred=False, mask=None, time_embedding_table=None, layer_cache=None):
         """
         Apply the model to an input batch.
 
@@ -269,13 +442,24 @@ class DiffusionTts(nn.Module):
         :param conditioning_latent: a pre-computed conditioning latent; see get_conditioning().
         :param precomputed_aligned_embeddings: Embeddings returned from self.timestep_independent()
         :param conditioning_free: When set, all conditioning inputs (including tokens and conditioning_input) will not be considered.
+                                  Can also be a 1-D boolean batch, in which case this applies to the marked elements only.
+        :param mask: an optional [N x T] boolean Tensor marking which positions of x hold data, for batches of padded
+                     inputs with different lengths. Padded positions do not affect the output at the other positions.
+        :param time_embedding_table: Time embeddings returned from self.precompute_time_embeddings(). Timesteps that are
+                                     not in the table raise a ValueError, or fail a device-side assert off the CPU.
+        :param layer_cache: an optional LayerCache to reuse the middle layers' work across sampling steps. Eval mode only.
         :return: an [N x C x ...] Tensor of outputs.
         """
         assert precomputed_aligned_embeddings is not None or (aligned_conditioning is not None and conditioning_latent is not None)
         assert not (return_code_pred and precomputed_aligned_embeddings is not None)  # These two are mutually exclusive.
+        if not self.training:
+            return self.inference_forward(x, timesteps, aligned_conditioning, conditioning_latent, precomputed_aligned_embeddings,
+                                          conditioning_free, return_code_pred, mask, time_embedding_table, layer_cache)
+        assert layer_cache is None, 'Layer caching is only supported in eval mode.'
 
         unused_params = []
-        if conditioning_free:
+        per_element = torch.is_tensor(conditioning_free)
+        if not per_element and conditioning_free:
             code_emb = self.unconditioned_embedding.repeat(x.shape[0], 1, x.shape[-1])
             unused_params.extend(list(self.code_converter.parameters()) + list(self.code_embedding.parameters()))
             unused_params.extend(list(self.latent_conditioner.parameters()))
@@ -289,10 +473,15 @@ class DiffusionTts(nn.Module):
                 else:
                     unused_params.extend(list(self.latent_conditioner.parameters()))
 
-            unused_params.append(self.unconditioned_embedding)
+            if per_element:
+                code_emb = torch.where(conditioning_free.view(-1, 1, 1), self.unconditioned_embedding.type(code_emb.dtype), code_emb)
+            else:
+                unused_params.append(self.unconditioned_embedding)
 
-        time_emb = self.time_embed(timestep_embedding(timesteps, self.model_channels))
-        code_emb = self.conditioning_timestep_integrator(code_emb, time_emb)
+        time_emb = self.time_embedding(timesteps, time_embedding_table)
+        code_emb = self.conditioning_timestep_integrator(code_emb, time_emb, mask)
+        if mask is not None:
+            x = x * mask.unsqueeze(1)
         x = self.inp_block(x)
         x = torch.cat([x, code_emb], dim=1)
         x = self.integrating_conv(x)
@@ -304,23 +493,72 @@ class DiffusionTts(nn.Module):
                 # First and last blocks will have autocast disabled for improved precision.
                 if not torch.backends.mps.is_available():
                     with autocast(x.device.type, enabled=self.enable_fp16 and i != 0):
-                        x = lyr(x, time_emb)
+                        x = lyr(x, time_emb, mask)
                 else:
-                    x = lyr(x, time_emb)
+                    x = lyr(x, time_emb, mask)
 
         x = x.float()
-        out = self.out(x)
+        out = self.out(x) if mask is None else masked_sequential(self.out, x, mask)
 
         # Involve probabilistic or possibly unused parameters in loss so we don't get DDP errors.
-        extraneous_addition = 0
-        for p in unused_params:
-            extraneous_addition = extraneous_addition + p.mean()
-        out = out + extraneous_addition * 0
+        if torch.is_grad_enabled():
+            extraneous_addition = 0
+            for p in unused_params:
+                extraneous_addition = extraneous_addition + p.mean()
+            out = out + extraneous_addition * 0
 
         if return_code_pred:
             return out, mel_pred
         return out
 
+    def inference_forward(self, x, timesteps, aligned_conditioning=None, conditioning_latent=None, precomputed_aligned_embeddings=None,
+                          conditioning_free=False, return_code_pred=False, mask=None, time_embedding_table=None, layer_cache=None):
+        """
+        Same as forward(), without layer drop and the bookkeeping that keeps DDP training working. forward() calls this
+        when the model is in eval mode.
+
+        :param layer_cache: an optional LayerCache, which skips the middle layers on most calls.
+        """
+        per_element = torch.is_tensor(conditioning_free)
+        if not per_element and conditioning_free:
+            code_emb = self.unconditioned_embedding.repeat(x.shape[0], 1, x.shape[-1])
+        else:
+            if precomputed_aligned_embeddings is not None:
+                code_emb = precomputed_aligned_embeddings
+            else:
+                code_emb, mel_pred = self.timestep_independent(aligned_conditioning, conditioning_latent, x.shape[-1], True)
+            if per_element:
+                code_emb = torch.where(conditioning_free.view(-1, 1, 1), self.unconditioned_embedding.type(code_emb.dtype), code_emb)
+
+        time_emb = self.time_embedding(timesteps, time_embedding_table)
+        code_emb = self.conditioning_timestep_integrator(code_emb, time_emb, mask)
+        if mask is not None:
+            x = x * mask.unsqueeze(1)
+        x = self.inp_block(x)
+        x = torch.cat([x, code_emb], dim=1)
+        x = self.integrating_conv(x)
+        if torch.backends.mps.is_available():
+            precise, mixed = nullcontext(), nullcontext()
+        else:
+            # The first block has autocast disabled for improved precision.
+            precise = autocast(x.device.type, enabled=False)
+            mixed = autocast(x.device.type, enabled=self.enable_fp16)
+        with precise:
+            x = self.layers[0](x, time_emb, mask)
+        with mixed:
+            if layer_cache is not None:
+                role = 'doubled' if per_element else 'unconditioned' if conditioning_free else 'conditioned'
+                x = layer_cache.apply(self.layers[1:], x, time_emb, mask, role)
+            else:
+                for lyr in self.layers[1:]:
+                    x = lyr(x, time_emb, mask)
+
+        x = x.float()
+        out = self.out(x) if mask is None else masked_sequential(self.out, x, mask)
+        if return_code_pred:
+            return out, mel_pred
+        return out
+
 
 if __name__ == '__main__':
     clip = torch.randn(2, 100, 400)
@@ -332,5 +570,83 @@ if __name__ == '__main__':
     # Test with latent aligned conditioning
     #o = model(clip, ts, aligned_latent, cond)
     # Test with sequence aligned conditioning
-    o = model(clip, ts, aligned_sequence, cond)
-
+    o = model(clip, ts, aligned_sequence, model.get_conditioning(cond))
+
+
+    # Check that padded, masked batch elements come out the same as when run on their own.
+    model = DiffusionTts(64, num_layers=2, in_latent_channels=64, num_heads=4, layer_drop=0, unconditioned_percentage=0).eval()
+    lengths = [120, 68]
+    with torch.no_grad():
+        embs = [model.timestep_independent(torch.randn(1, length // 4, 64), torch.randn(1, 128), length, False) for length in lengths]
+        xs = [torch.randn(1, 100, length) for length in lengths]
+        ts = torch.LongTensor([500, 120])
+        mask = torch.arange(max(lengths)).unsqueeze(0) < torch.tensor(lengths).unsqueeze(1)
+        padded = model(torch.cat([F.pad(x, (0, max(lengths) - x.shape[-1])) for x in xs]), ts,
+                       precomputed_aligned_embeddings=torch.cat([F.pad(e, (0, max(lengths) - e.shape[-1])) for e in embs]),
+                       mask=mask)
+        # Looked up time embeddings match computed ones, and timesteps missing from the table are refused.
+        table = model.precompute_time_embeddings(torch.LongTensor([120, 300, 500]))
+        assert torch.allclose(model.time_embedding(ts, table), model.time_embedding(ts), atol=1e-6)
+        try:
+            model.precompute_time_embeddings(torch.LongTensor([300, 120]))
+            assert False, 'A time embedding table was precomputed for unsorted timesteps.'
+        except ValueError:
+            pass
+        for missing in ([121, 500], [501, 120]):
+            try:
+                model.time_embedding(torch.LongTensor(missing), table)
+                assert False, 'A timestep missing from the table was looked up.'
+            except ValueError:
+                pass
+        for i, (x, e) in enumerate(zip(xs, embs)):
+            single = model(x, ts[i:i+1], precomputed_aligned_embeddings=e)
+            assert torch.allclose(padded[i:i+1, :, :lengths[i]], single, atol=1e-4), f'Batch element {i} differs.'
+
+        # The eval mode fast path must match the training forward when nothing is dropped.
+        cond_free = torch.tensor([False, True])
+        expected = model.train()(xs[0].repeat(2, 1, 1), ts, precomputed_aligned_embeddings=embs[0].repeat(2, 1, 1),
+                                 conditioning_free=cond_free)
+        actual = model.eval()(xs[0].repeat(2, 1, 1), ts, precomputed_aligned_embeddings=embs[0].repeat(2, 1, 1),
+                              conditioning_free=cond_free)
+        assert torch.allclose(expected, actual, atol=1e-5), 'The eval mode forward differs.'
+
+        # A window that covers the whole input is the plain model, and windows over padding must not produce NaNs.
+        x = torch.cat([F.pad(x, (0, max(lengths) - x.shape[-1])) for x in xs])
+        e = torch.cat([F.pad(e, (0, max(lengths) - e.shape[-1])) for e in embs])
+        assert torch.equal(WindowedDiffusion(model, window=128)(x, ts, precomputed_aligned_embeddings=e, mask=mask),
+                           model(x, ts, precomputed_aligned_embeddings=e, mask=mask)), 'A single window differs.'
+        windowed = WindowedDiffusion(model, window=32, overlap=8)(x, ts, precomputed_aligned_embeddings=e, mask=mask)
+        assert windowed.shape == (2, 200, max(lengths)) and not windowed.isnan().any(), 'Windowing failed.'
+    print('Padded batches match unpadded inputs and the eval mode forward matches the training one.')
+
+    # Benchmarks LayerCache: sampling speed and the distance of the resulting spectrograms from full computation.
+    import time
+    from tortoise.utils.diffusion import SpacedDiffusion, space_timesteps, get_named_beta_schedule
+
+    torch.manual_seed(0)
+    model = DiffusionTts(256, num_layers=8, in_latent_channels=256, num_heads=8, layer_drop=0, unconditioned_percentage=0).eval()
+    # The output layers of a fresh model are zero initialized, which would make every output the same.
+    for p in model.parameters():
+        if p.dim() > 1 and not p.any():
+            nn.init.normal_(p, std=.02)
+    diffuser = SpacedDiffusion(use_timesteps=space_timesteps(4000, [30]), model_mean_type='epsilon',
+                               model_var_type='learned_range', loss_type='mse',
+                               betas=get_named_beta_schedule('linear', 4000), conditioning_free=False)
+    with torch.no_grad():
+        length = 200
+        emb = model.timestep_independent(torch.randn(1, length // 4, 256), torch.randn(1, 512), length, False)
+        noise = torch.randn(1, 100, length)
+        results = {}
+        for interval in (None, 2, 3, 5):
+            torch.manual_seed(1)
+            model_kwargs = {'precomputed_aligned_embeddings': emb}
+            if interval is not None:
+                model_kwargs['layer_cache'] = LayerCache(refresh_interval=interval)
+            start = time.perf_counter()
+            mel = diffuser.p_sample_loop(model, noise.shape, noise=noise, model_kwargs=model_kwargs, progress=False)
+            elapsed = time.perf_counter() - start
+            results[interval] = mel
+            distance = (mel - results[None]).abs().mean().item()
+            print(f'refresh_interval={interval}: {30 / elapsed:.2f} steps/sec, '
+                  f'mean abs. spectrogram distance from full computation {distance:.4f}')
+    print(f'(The mean abs. spectrogram value is {results[None].abs().mean().item():.4f}.)')
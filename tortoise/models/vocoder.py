@@ -1,8 +1,11 @@
+import math
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 MAX_WAV_VALUE = 32768.0
+LVC_IMPLEMENTATIONS = ('einsum', 'bmm')
 
 class KernelPredictor(torch.nn.Module):
     ''' Kernel predictor for the location-variable convolutions'''
@@ -116,9 +119,18 @@ class LVCBlock(torch.nn.Module):
             kpnet_hidden_channels=64,
             kpnet_conv_size=3,
             kpnet_dropout=0.0,
+            lvc_implementation='einsum',
     ):
+        '''
+        Args:
+            lvc_implementation (str): how the location-variable convolutions are computed, one of LVC_IMPLEMENTATIONS.
+                'einsum' is location_variable_convolution() and 'bmm' is location_variable_convolution_bmm(), which is
+                faster on CPU and gives the same result.
+        '''
         super().__init__()
 
+        assert lvc_implementation in LVC_IMPLEMENTATIONS, f'Unknown LVC implementation {lvc_implementation}.'
+        self.lvc_implementation = lvc_implementation
         self.cond_hop_length = cond_hop_length
         self.conv_layers = len(dilations)
         self.conv_kernel_size = conv_kernel_size
@@ -172,8 +184,11 @@ class LVCBlock(torch.nn.Module):
             k = kernels[:, i, :, :, :, :]  # (B, 2 * c_g, c_g, kernel_size, cond_length)
             b = bias[:, i, :, :]  # (B, 2 * c_g, cond_length)
 
-            output = self.location_variable_convolution(output, k, b,
-                                                        hop_size=self.cond_hop_length)  # (B, 2 * c_g, stride * L'): LVC
+            if self.lvc_implementation == 'bmm':
+                output = self.location_variable_convolution_bmm(output, k, b, hop_size=self.cond_hop_length)
+            else:
+                output = self.location_variable_convolution(output, k, b,
+                                                            hop_size=self.cond_hop_length)  # (B, 2 * c_g, stride * L'): LVC
             x = x + torch.sigmoid(output[:, :in_channels, :]) * torch.tanh(
                 output[:, in_channels:, :])  # (B, c_g, stride * L'): GAU
 
@@ -215,6 +230,36 @@ class LVCBlock(torch.nn.Module):
 
         return o
 
+    def location_variable_convolution_bmm(self, x, kernel, bias, dilation=1, hop_size=256):
+        ''' perform the same location-variable convolution as location_variable_convolution(), as one batched matrix
+        multiplication per batch element and kernel location: the (hop_size, in_channels * kernel_size) patches of a
+        location are multiplied with its (in_channels * kernel_size, out_channels) kernel, starting from the bias. This
+        replaces the 6-D einsum and the copies around it with a single unfold and a single baddbmm.
+        Args:
+            x (Tensor): the input sequence (batch, in_channels, in_length).
+            kernel (Tensor): the local convolution kernel (batch, in_channel, out_channels, kernel_size, kernel_length)
+            bias (Tensor): the bias for the local convolution (batch, out_channels, kernel_length)
+            dilation (int): the dilation of convolution.
+            hop_size (int): the hop_size of the conditioning sequence.
+        Returns:
+            (Tensor): the output sequence after performing local convolution. (batch, out_channels, in_length).
+        '''
+        batch, in_channels, in_length = x.shape
+        batch, _, out_channels, kernel_size, kernel_length = kernel.shape
+        assert in_length == (kernel_length * hop_size), "length of (x, kernel) is not matched"
+
+        padding = dilation * int((kernel_size - 1) / 2)
+        x = F.pad(x, (padding, padding), 'constant', 0)  # (batch, in_channels, in_length + 2*padding)
+        x = x.unfold(2, dilation * (kernel_size - 1) + 1, 1)[..., ::dilation]  # (batch, in_channels, in_length, kernel_size)
+        x = x.reshape(batch, in_channels, kernel_length, hop_size, kernel_size).permute(0, 2, 3, 1, 4)
+        x = x.reshape(batch * kernel_length, hop_size, in_channels * kernel_size)
+        kernel = kernel.permute(0, 4, 1, 3, 2).reshape(batch * kernel_length, in_channels * kernel_size, out_channels)
+        bias = bias.transpose(1, 2).reshape(batch * kernel_length, 1, out_channels)
+
+        o = torch.baddbmm(bias, x, kernel)  # (batch * kernel_length, hop_size, out_channels)
+        o = o.view(batch, kernel_length, hop_size, out_channels).permute(0, 3, 1, 2)
+        return o.reshape(batch, out_channels, in_length)
+
     def remove_weight_norm(self):
         self.kernel_predictor.remove_weight_norm()
         nn.utils.remove_weight_norm(self.convt_pre[1])
@@ -231,7 +276,7 @@ class UnivNetGenerator(nn.Module):
 
     def __init__(self, noise_dim=64, channel_size=32, dilations=[1,3,9,27], strides=[8,8,4], lReLU_slope=.2, kpnet_conv_size=3,
                  # Below are MEL configurations options that this generator requires.
-                 hop_length=256, n_mel_channels=100):
+                 hop_length=256, n_mel_channels=100, lvc_implementation='einsum'):
         super(UnivNetGenerator, self).__init__()
         self.mel_channel = n_mel_channels
         self.noise_dim = noise_dim
@@ -251,7 +296,8 @@ class UnivNetGenerator(nn.Module):
                     dilations=dilations,
                     lReLU_slope=lReLU_slope,
                     cond_hop_length=hop_length,
-                    kpnet_conv_size=kpnet_conv_size
+                    kpnet_conv_size=kpnet_conv_size,
+                    lvc_implementation=lvc_implementation,
                 )
             )
 
@@ -297,7 +343,32 @@ class UnivNetGenerator(nn.Module):
         for res_block in self.res_stack:
             res_block.remove_weight_norm()
 
-    def inference(self, c, z=None):
+    def context_frames(self):
+        """
+        Returns how many spectrogram frames on either side of a frame the audio of that frame can depend on. This is an
+        upper bound, worked out from the padding of every convolution on the way from the spectrogram to the audio.
+        """
+        frames = self.conv_pre.padding[0] + math.ceil(self.conv_post[1].padding[0] / self.hop_length)
+        predictor_frames = 0
+        for block in self.res_stack:
+            # The transposed convolution reaches at most a frame further, and every conv block is followed by a
+            # location-variable convolution with a kernel of the same size.
+            samples = sum(conv[1].padding[0] for conv in block.conv_blocks) + \
+                      block.conv_layers * (block.conv_kernel_size - 1) // 2
+            frames += 1 + math.ceil(samples / block.cond_hop_length)
+            predictor = block.kernel_predictor
+            predictor_frames = max(predictor_frames, predictor.input_conv[0].padding[0] + predictor.kernel_conv.padding[0] +
+                                   sum(conv[1].padding[0] + conv[3].padding[0] for conv in predictor.residual_convs))
+        return frames + predictor_frames
+
+    def inference(self, c, z=None, chunk_size=None):
+        """
+        Vocodes the spectrogram <c>. When <chunk_size> is set, the audio is produced <chunk_size> frames at a time; see
+        inference_chunks(). Both give the same audio for the same noise.
+        """
+        if chunk_size is not None:
+            return torch.cat(list(self.inference_chunks(c, z, chunk_size)), dim=-1)
+
         # pad input mel with zeros to cut artifact
         # see https://github.com/seungwonpark/melgan/issues/8
         zero = torch.full((c.shape[0], self.mel_channel, 10), -11.5129).to(c.device)
@@ -311,6 +382,45 @@ class UnivNetGenerator(nn.Module):
         audio = audio.clamp(min=-1, max=1)
         return audio
 
+    def inference_batch(self, mels, z=None, chunk_size=None):
+        """
+        Vocodes a list of (b,mel_channels,s) spectrograms of different lengths in a single forward pass: they are padded
+        to the longest with the same silence inference() pads with, and the audio of each is trimmed back to
+        hop_length samples per frame of it. Returns the audio of each spectrogram, in the same order.
+        """
+        lengths = [mel.shape[-1] for mel in mels]
+        longest = max(lengths)
+        c = torch.cat([F.pad(mel, (0, longest - mel.shape[-1]), value=-11.5129) for mel in mels], dim=0)
+        audio = self.inference(c, z, chunk_size)
+        clips = []
+        start = 0
+        for mel, length in zip(mels, lengths):
+            clips.append(audio[start:start + mel.shape[0], :, :length * self.hop_length])
+            start += mel.shape[0]
+        return clips
+
+    def inference_chunks(self, c, z=None, chunk_size=64, context=None):
+        """
+        Vocodes the spectrogram <c> in windows of <chunk_size> frames, each extended by <context> frames on either side
+        (by default context_frames()), and yields the audio of each window, chunk_size * hop_length samples at a time,
+        as soon as it is ready. The memory used no longer grows with the length of <c>, and with the default context
+        the audio is the same as what inference() produces from the same noise <z>, up to floating point error.
+        """
+        if context is None:
+            context = self.context_frames()
+        frames = c.shape[-1]
+        zero = torch.full((c.shape[0], self.mel_channel, 10), -11.5129).to(c.device)
+        mel = torch.cat((c, zero), dim=2)
+
+        if z is None:
+            z = torch.randn(c.shape[0], self.noise_dim, mel.size(2)).to(mel.device)
+
+        for start in range(0, frames, chunk_size):
+            end = min(start + chunk_size, frames)
+            window_start, window_end = max(start - context, 0), min(end + context, mel.shape[-1])
+            audio = self.forward(mel[:, :, window_start:window_end], z[:, :, window_start:window_end])
+            audio = audio[:, :, (start - window_start) * self.hop_length:(end - window_start) * self.hop_length]
+            yield audio.clamp(min=-1, max=1)
 
 if __name__ == '__main__':
     model = UnivNetGenerator()
@@ -325,3 +435,72 @@ if __name__ == '__main__':
 
     pytorch_total_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print(pytorch_total_params)
+
+    # Checks that no frame's audio depends on frames further away than context_frames(), and that vocoding in chunks
+    # matches vocoding all at once.
+    model.eval(inference=True)
+    context = model.context_frames()
+    with torch.no_grad():
+        c = torch.randn(1, 100, 3 * context)
+        z = torch.randn(1, 64, 3 * context)
+        y = model(c, z)
+        c[:, :, 3 * context // 2] += 1
+        changed = (model(c, z) - y).abs().squeeze().view(-1, model.hop_length).amax(dim=1).nonzero()
+        reach = max(3 * context // 2 - changed.min().item(), changed.max().item() - 3 * context // 2)
+        print(f'Context of {context} frames; a change to one frame reaches {reach} frames.')
+        assert reach <= context
+
+        c = torch.randn(2, 100, 300)
+        z = torch.randn(2, 64, 310)
+        y = model.inference(c, z)
+        for chunk_size in (1, 37, 64, 500):
+            chunks = list(model.inference_chunks(c, z, chunk_size))
+            assert all(chunk.shape[-1] == chunk_size * model.hop_length for chunk in chunks[:-1])
+            difference = (torch.cat(chunks, dim=-1) - y).abs().max().item()
+            print(f'Chunks of {chunk_size} frames: largest difference {difference:.2e}')
+            assert difference < 1e-4
+
+    # Checks that spectrograms vocoded together come out at their own lengths and, given the same noise, the same as
+    # vocoding them one at a time. Only the audio near the end of the shorter ones, which sees more silence after it,
+    # can differ.
+    with torch.no_grad():
+        mels = [torch.randn(1, 100, length) for length in (120, 75, 200)]
+        z = torch.randn(3, 64, 210)
+        clips = model.inference_batch(mels, z)
+        for i, (mel, clip) in enumerate(zip(mels, clips)):
+            assert clip.shape == (1, 1, mel.shape[-1] * model.hop_length)
+            alone = model.inference(mel, z[i:i + 1, :, :mel.shape[-1] + 10])
+            end = (mel.shape[-1] - context) * model.hop_length
+            assert torch.allclose(clip[..., :end], alone[..., :end], atol=1e-4)
+        print('Batched vocoding matches vocoding one spectrogram at a time.')
+
+    # Checks that the LVC implementations agree, and times them at the hop sizes of the three LVC blocks.
+    import time
+
+    block = model.res_stack[0]
+    for hop_size in (8, 64, 256):
+        x = torch.randn(1, 32, 200 * hop_size)
+        kernel = torch.randn(1, 32, 64, 3, 200)
+        bias = torch.randn(1, 64, 200)
+        with torch.no_grad():
+            expected = block.location_variable_convolution(x, kernel, bias, hop_size=hop_size)
+            for implementation in LVC_IMPLEMENTATIONS:
+                lvc = block.location_variable_convolution_bmm if implementation == 'bmm' else \
+                    block.location_variable_convolution
+                assert torch.allclose(lvc(x, kernel, bias, hop_size=hop_size), expected, atol=1e-4)
+                start = time.perf_counter()
+                for _ in range(10):
+                    lvc(x, kernel, bias, hop_size=hop_size)
+                print(f'LVC {implementation} at hop size {hop_size}: {(time.perf_counter() - start) * 100:.2f}ms')
+
+    c = torch.randn(1, 100, 200)
+    z = torch.randn(1, 64, 200)
+    with torch.no_grad():
+        y = model(c, z)
+        for implementation in LVC_IMPLEMENTATIONS:
+            for block in model.res_stack:
+                block.lvc_implementation = implementation
+            assert torch.allclose(model(c, z), y, atol=1e-4)
+            start = time.perf_counter()
+            model(c, z)
+            print(f'Generator with {implementation} LVC on 200 frames: {time.perf_counter() - start:.2f}s')
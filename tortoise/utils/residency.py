@@ -0,0 +1,113 @@
+from collections import OrderedDict
+
+import torch
+
+
+def model_size_bytes(model):
+    """
+    Returns the number of bytes occupied by the parameters and buffers of <model>.
+    """
+    size = sum(p.numel() * p.element_size() for p in model.parameters())
+    return size + sum(b.numel() * b.element_size() for b in model.buffers())
+
+
+def model_device(model):
+    """
+    Returns the device that the parameters of <model> live on, or None if it has no parameters or buffers.
+    """
+    for t in model.parameters():
+        return t.device
+    for t in model.buffers():
+        return t.device
+    return None
+
+
+class ModelResidency:
+    """
+    Decides which models are kept on the execution device between uses, and counts how many bytes are copied between
+    the host and the device as a result.
+
+    Policies:
+        'offload': Models are moved to the device when they are used and back to the CPU right afterwards. Uses the least
+                   device memory. This is the default.
+        'resident': Models are moved to the device the first time they are used and stay there.
+        'lru': Models stay on the device after use until room is needed for another model. The total size of the models
+               kept on the device is held under memory_budget bytes by offloading the least recently used models first.
+               With no memory_budget this behaves like 'resident'.
+    """
+    POLICIES = ('offload', 'resident', 'lru')
+
+    def __init__(self, device, policy='offload', memory_budget=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown residency policy "{policy}". Options are: {", ".join(self.POLICIES)}.')
+        self.device = torch.device(device)
+        self.policy = policy
+        self.memory_budget = memory_budget
+        self.resident = OrderedDict()  # id(model) -> (model, size in bytes), least recently used first.
+        self.in_use = {}  # id(model) -> number of callers currently using the model.
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.bytes_to_device = 0
+        self.bytes_to_host = 0
+
+    @property
+    def bytes_moved(self):
+        return self.bytes_to_device + self.bytes_to_host
+
+    @property
+    def resident_bytes(self):
+        return sum(size for _, size in self.resident.values())
+
+    def acquire(self, model):
+        """
+        Makes sure <model> is on the execution device and marks it as in use until release() is called.
+        """
+        key = id(model)
+        self.in_use[key] = self.in_use.get(key, 0) + 1
+        if key in self.resident:
+            self.resident.move_to_end(key)
+            return model
+        size = model_size_bytes(model)
+        if self.policy == 'lru' and self.memory_budget is not None:
+            self._evict_until(self.memory_budget - size)
+        self._move(model, self.device, size)
+        self.resident[key] = (model, size)
+        return model
+
+    def release(self, model):
+        """
+        Marks <model> as no longer in use, offloading it to the CPU if the policy calls for it.
+        """
+        key = id(model)
+        self.in_use[key] -= 1
+        if self.in_use[key] == 0:
+            del self.in_use[key]
+            if self.policy == 'offload':
+                self.evict(model)
+
+    def evict(self, model):
+        """
+        Moves <model> back to the CPU if it is being kept on the execution device.
+        """
+        key = id(model)
+        if key in self.resident:
+            model, size = self.resident.pop(key)
+            self._move(model, torch.device('cpu'), size)
+
+    def _evict_until(self, budget):
+        for key in list(self.resident.keys()):
+            if self.resident_bytes <= budget:
+                break
+            if key not in self.in_use:
+                self.evict(self.resident[key][0])
+
+    def _move(self, model, device, size):
+        current = model_device(model)
+        model.to(device)
+        if current is None or current == model_device(model):
+            return
+        if device.type == 'cpu':
+            self.bytes_to_host += size
+        else:
+            self.bytes_to_device += size